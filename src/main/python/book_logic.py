@@ -1,8 +1,9 @@
 
 from shared import *
+from corpus import Corpus
 
 from types import SimpleNamespace
-import json
+from functools import lru_cache
 
 # bible = {}
 #
@@ -22,34 +23,47 @@ def get_num_chapters(book):
     return CHAPTER_COUNTS[book]
 
 def has_chapters(book):
-    return get_num_chapters_for(book) is not 1
+    return get_num_chapters_for(book) != 1
+
+BOOK_INDEXES = {name: i for i, name in enumerate(BOOK_NAMES)}
 
 ### --- new, once on app startup
 
-def load_old_book(book_name):
-    fp = BOOK_FP_TEMPLATE.format(book_name)
-    with open(fp, 'r') as file:
-        return json.load(file)
-
-def load_bible_json():
-    bible = {}
-    for book_name in BOOK_NAMES:
-        book = load_old_book(book_name)
-
-        if has_chapters(book_name):
-            chapters = book
-            # result = []
-            result = {}
-            for i in range(1, len(chapters)+1):
-                verses = chapters[str(i)]
-                # result.append(verses_dict_to_arr(verses))
-                result[str(i)] = verses
-            bible[book_name] = result
-        else:
-            verses = book
-            # bible[book_name] = verses_dict_to_arr(verses)
-            bible[book_name] = verses
-    return bible
+def load_bible(cache_size=BOOK_CACHE_SIZE):
+    return Bible(Corpus(CORPUS_FP, METADATA), cache_size)
+
+class Bible:
+    '''Verse text by corpus row, decoded a book at a time.
+    The most recently used books are kept decoded; see cache_info() for hits and misses.
+
+    rows = bible.corpus.chapter_rows(BOOK_INDEXES['Genesis'], 3)
+    bible.text(rows[14])
+    >>> 'And I will put enmity between you and the woman...' '''
+
+    def __init__(self, corpus, cache_size=BOOK_CACHE_SIZE):
+        self.corpus = corpus
+        self._cached_book = lru_cache(maxsize=cache_size)(self._load_book)
+
+    def text(self, row):
+        book, _, _ = self.corpus.location(row)
+        first_row = self.corpus.book_rows(book).start
+        return self._cached_book(book)[row - first_row]
+
+    def cache_info(self):
+        # (hits, misses, maxsize, currsize)
+        return self._cached_book.cache_info()
+
+    def _load_book(self, book):
+        return self.corpus.texts(self.corpus.book_rows(book))
+
+    def iter_verses(self, rows=None):
+        # (row, text) for a range of rows, default the whole bible, read a book at a time.
+        #  bypasses the cache so a whole-Bible scan doesn't evict the books being read
+        rows = range(self.corpus.num_verses) if rows is None else rows
+        for book in range(self.corpus.num_books):
+            book_rows = self.corpus.book_rows(book)
+            chunk = range(max(rows.start, book_rows.start), min(rows.stop, book_rows.stop))
+            yield from zip(chunk, self.corpus.texts(chunk))
 
 def verses_dict_to_arr(verses):
     result = []
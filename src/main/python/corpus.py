@@ -0,0 +1,232 @@
+'''Single-file packed corpus, replacing the json file per book.
+
+Layout, little endian:
+    header   magic, format version, book count, verse count, block count
+    ids      one u32 verse id per verse, see pack_id()
+    offsets  one u32 text offset per verse, then the end, counted in the uncompressed text
+    blocks   u32 first row of each block, then the verse count
+    starts   u32 byte offset of each block in the blob, then the end
+    blob     utf-8 text of every verse, back to back, zlib compressed a block at a time
+
+Each chapter is its own block, so a chapter is read with one small decompress
+and nothing around it. Written once by setup.py. The app mmaps it and
+only decompresses and decodes verse text when asked.'''
+
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+MAGIC = b'FBIB'
+VERSION = 3
+
+_HEADER = struct.Struct('<4sHHII')
+BLOCK_CACHE_SIZE = 16   # decompressed blocks kept, for lookups one verse at a time
+
+def pack_id(book, chapter, verse):
+    # one sortable int per verse; canonical order is numeric order.
+    #  chapters and verses both stay under 256 (Psalms 150, Psalm 119:176)
+    return book << 16 | chapter << 8 | verse
+
+def unpack_id(verse_id):
+    return (verse_id >> 16, verse_id >> 8 & 0xFF, verse_id & 0xFF)
+
+def write_corpus(fp, books):
+    '''books: parsed book dicts in BOOK_NAMES order, as returned by setup.parse_book().
+    Chapterless books are stored as chapter 1.'''
+    ids = array('I')
+    offsets = array('I', [0])
+    block_rows = array('I')
+    block_starts = array('I')
+    blob = bytearray()
+    num_books = 0
+
+    for book_index, book in enumerate(books):
+        num_books += 1
+        for chapter, verses in iter_parsed_chapters(book):
+            block = bytearray()
+            block_rows.append(len(ids))
+            block_starts.append(len(blob))
+            for verse, text in verses.items():
+                ids.append(pack_id(book_index, int(chapter), int(verse)))
+                encoded = text.encode('utf-8')
+                block += encoded
+                offsets.append(offsets[-1] + len(encoded))
+            blob += zlib.compress(bytes(block), 9)
+    block_rows.append(len(ids))
+    block_starts.append(len(blob))
+
+    arrays = (ids, offsets, block_rows, block_starts)
+    if sys.byteorder == 'big':
+        for arr in arrays:
+            arr.byteswap()
+
+    # write beside the target and swap in, so a failed setup never leaves half a corpus
+    tmp_fp = str(fp) + '.tmp'
+    with open(tmp_fp, 'wb') as file:
+        file.write(_HEADER.pack(MAGIC, VERSION, num_books, len(ids), len(block_rows)-1))
+        for arr in arrays:
+            arr.tofile(file)
+        file.write(blob)
+    os.replace(tmp_fp, str(fp))
+
+def read_parsed_book(corpus, book):
+    # back to the {chapter: {verse: text}} dict it was written from
+    parsed = {}
+    rows = corpus.book_rows(book)
+    for row, text in zip(rows, corpus.texts(rows)):
+        _, chapter, verse = corpus.location(row)
+        parsed.setdefault(str(chapter), {})[str(verse)] = text
+    return parsed
+
+def iter_parsed_chapters(book):
+    # parsed books are {chapter: {verse: text}}, or just {verse: text} when chapterless
+    first = next(iter(book.values()))
+    if isinstance(first, dict):
+        yield from book.items()
+    else:
+        yield ('1', book)
+
+class Corpus:
+    '''Read-only columnar view of a packed corpus file.
+
+    Verses are addressed by row: their position in canonical order.
+    ids and offsets are arrays, and prefix sums over chapters make every
+    book or chapter a contiguous range of rows. Text stays compressed in the mmap until asked for.
+
+    corpus = Corpus('bible.bin')
+    rows = corpus.chapter_rows(0, 1)
+    corpus.text(rows[0])
+    >>> 'In the beginning God created...' '''
+
+    def __init__(self, fp, metadata=None):
+        # metadata: Metadata from setup, whose offsets are used instead of computing them
+        with open(fp, 'rb') as file:
+            self._mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mm) < _HEADER.size:
+            raise ValueError('unrecognized corpus file: {}'.format(fp))
+        magic, version, self.num_books, self.num_verses, num_blocks = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('unrecognized corpus file: {}'.format(fp))
+
+        n = self.num_verses
+        ids_start = _HEADER.size
+        offsets_start = ids_start + 4*n
+        block_rows_start = offsets_start + 4*(n+1)
+        block_starts_start = block_rows_start + 4*(num_blocks+1)
+        self._blob_start = block_starts_start + 4*(num_blocks+1)
+
+        self.ids = _read_u32s(self._mm, ids_start, n)
+        self.offsets = _read_u32s(self._mm, offsets_start, n+1)
+        self.block_rows = _read_u32s(self._mm, block_rows_start, num_blocks+1)
+        self._block_starts = _read_u32s(self._mm, block_starts_start, num_blocks+1)
+        self._block = lru_cache(maxsize=BLOCK_CACHE_SIZE)(self._decompress_block)
+        if metadata is not None and metadata.num_verses == n and len(metadata.book_chapter_starts) == self.num_books+1:
+            self.book_chapter_starts = metadata.book_chapter_starts
+            self.chapter_starts = metadata.chapter_starts
+        else:
+            self._index_chapters()
+
+    def _index_chapters(self):
+        # prefix sums: chapter slots are numbered across the whole bible,
+        #  with each book's slots starting at book_chapter_starts[book]
+        chapter_counts = [0] * self.num_books
+        for verse_id in self.ids:
+            book, chapter, _ = unpack_id(verse_id)
+            chapter_counts[book] = max(chapter_counts[book], chapter)
+
+        self.book_chapter_starts = array('I', [0])
+        for count in chapter_counts:
+            self.book_chapter_starts.append(self.book_chapter_starts[-1] + count)
+
+        num_slots = self.book_chapter_starts[-1]
+        starts = array('l', [-1]) * (num_slots+1)
+        starts[num_slots] = self.num_verses
+        prev_slot = None
+        for row, verse_id in enumerate(self.ids):
+            book, chapter, _ = unpack_id(verse_id)
+            slot = self.book_chapter_starts[book] + chapter - 1
+            if slot != prev_slot:
+                starts[slot] = row
+                prev_slot = slot
+        for slot in range(num_slots-1, -1, -1):
+            if starts[slot] == -1:     # missing chapter is an empty range
+                starts[slot] = starts[slot+1]
+        self.chapter_starts = array('I', starts)
+
+    ### --- ranges and lookups
+
+    def num_chapters(self, book):
+        return self.book_chapter_starts[book+1] - self.book_chapter_starts[book]
+
+    def book_rows(self, book):
+        first_slot = self.book_chapter_starts[book]
+        end_slot = self.book_chapter_starts[book+1]
+        return range(self.chapter_starts[first_slot], self.chapter_starts[end_slot])
+
+    def chapter_rows(self, book, chapter):
+        if not 1 <= chapter <= self.num_chapters(book):
+            return range(0)
+        slot = self.book_chapter_starts[book] + chapter - 1
+        return range(self.chapter_starts[slot], self.chapter_starts[slot+1])
+
+    def find_row(self, book, chapter, verse):
+        # row of the verse, or None. bisects within its chapter
+        rows = self.chapter_rows(book, chapter)
+        verse_id = pack_id(book, chapter, verse)
+        row = bisect_left(self.ids, verse_id, rows.start, rows.stop)
+        if row < rows.stop and self.ids[row] == verse_id:
+            return row
+        return None
+
+    def location(self, row):
+        # (book, chapter, verse) of a row
+        return unpack_id(self.ids[row])
+
+    def verse_num(self, row):
+        return self.ids[row] & 0xFF
+
+    ### --- text
+
+    def text(self, row):
+        block = bisect_right(self.block_rows, row) - 1
+        data = self._block(block)
+        base = self.offsets[self.block_rows[block]]
+        return data[self.offsets[row]-base : self.offsets[row+1]-base].decode('utf-8')
+
+    def texts(self, rows):
+        # decodes a contiguous range of rows, decompressing each block it touches once
+        result = []
+        if not rows:
+            return result
+        block = bisect_right(self.block_rows, rows.start) - 1
+        row = rows.start
+        while row < rows.stop:
+            stop = min(rows.stop, self.block_rows[block+1])
+            data = self._decompress_block(block)    # skips the cache, so a long scan doesn't flush it
+            base = self.offsets[self.block_rows[block]]
+            result.extend(data[self.offsets[i]-base : self.offsets[i+1]-base].decode('utf-8') for i in range(row, stop))
+            row = stop
+            block += 1
+        return result
+
+    def _decompress_block(self, block):
+        start = self._blob_start + self._block_starts[block]
+        stop = self._blob_start + self._block_starts[block+1]
+        return zlib.decompress(self._mm[start:stop])
+
+    def close(self):
+        self._block.cache_clear()
+        self._mm.close()
+
+def _read_u32s(buffer, start, count):
+    result = array('I')
+    result.frombytes(buffer[start : start + 4*count])
+    if sys.byteorder == 'big':
+        result.byteswap()
+    return result
@@ -0,0 +1,288 @@
+'''Downloading for setup and the updater, over one pooled requests session.
+
+download() streams a file to disk, resuming with Range requests after a dropped
+connection, retrying with backoff, and checking the result before it's put in place.
+Large files from servers that accept ranges are fetched as several ranges at once.
+get_json(), get_json_if_changed() and iter_range() cover the other requests around an update.'''
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import hashlib
+import json
+import os
+import re
+import time
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024     # bytes held in memory at once per connection
+DOWNLOAD_ATTEMPTS = 3
+DOWNLOAD_TIMEOUT = 30   # seconds without a response or data
+RETRY_BACKOFF = 0.5     # seconds before the first retry, doubling after each
+PARALLEL_RANGES = 4     # connections for one large download
+PARALLEL_MIN_SIZE = 4 * 1024 * 1024     # smaller files aren't worth splitting
+
+class DownloadError(Exception):
+    pass
+
+_session = None
+_session_lock = Lock()
+
+def session():
+    # shared by every download, so connections to the same host are reused
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=PARALLEL_RANGES)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+def get_json(url, timeout=DOWNLOAD_TIMEOUT):
+    # raises requests.RequestException, or ValueError if it isn't json
+    response = session().get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+def get_json_if_changed(url, etag=None, timeout=DOWNLOAD_TIMEOUT):
+    '''(json, etag) of url, or (None, etag) if it still matches etag from an earlier response.'''
+    headers = {'If-None-Match': etag} if etag else {}
+    response = session().get(url, headers=headers, timeout=timeout)
+    if response.status_code == 304:
+        return None, etag
+    response.raise_for_status()
+    return response.json(), response.headers.get('ETag')
+
+def fetch_range(url, start, stop):
+    '''Bytes start:stop of url, in one request. For small ranges; see iter_range().'''
+    return b''.join(iter_range(url, start, stop))
+
+def iter_range(url, start, stop):
+    '''Bytes start:stop of url a chunk at a time, streamed from one request,
+    so a large range is never held in memory whole.'''
+    headers = {'Range': 'bytes={}-{}'.format(start, stop-1)}
+    with _with_retries(lambda: session().get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT)) as response:
+        response.raise_for_status()
+        skip = start if response.status_code == 200 else 0     # server ignored the range
+        remaining = stop - start
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            if skip:
+                skipped = min(skip, len(chunk))
+                chunk, skip = chunk[skipped:], skip - skipped
+            chunk = chunk[:remaining]
+            if chunk:
+                remaining -= len(chunk)
+                yield chunk
+            if not remaining:
+                return
+
+def download(url, fp, progress=None, size=None, sha256=None, conditional=False):
+    '''Streams url to fp a chunk at a time, never holding it all in memory.
+
+    Data goes to fp.part first, which is kept if the connection drops;
+    the next attempt (or next call) asks for just the rest with a Range request.
+    A fresh download of at least PARALLEL_MIN_SIZE, from a server that accepts ranges,
+    is instead split into PARALLEL_RANGES ranges fetched side by side, and the bytes
+    each range wrote must add up to the size the server reported.
+    Once complete it's checked against size and sha256 if given, else the size the server reported,
+    then renamed to fp. Raises DownloadError if it can't be completed or doesn't check out.
+    Pass sha256 wherever it's known: the parallel fp.part is allocated at full size up front,
+    so the size alone says little about its content. If the process is killed partway through
+    a parallel download, that full size, partly zero-filled fp.part is left behind; the next call
+    asks for the bytes after it, gets a 416, and starts over.
+
+    The response's ETag and Last-Modified are saved beside fp. With conditional,
+    an existing fp from the same url is only downloaded again if the server says it changed.
+    Returns False if it hadn't, else True.
+
+    progress: called as progress(bytes_so_far, total_bytes), total None if unknown'''
+    part_fp = str(fp) + '.part'
+    validators = {}
+    if conditional and os.path.exists(str(fp)) and not os.path.exists(part_fp):
+        validators = _read_validators(fp, url)
+
+    error = None
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        if attempt:
+            time.sleep(RETRY_BACKOFF * 2 ** (attempt-1))
+        try:
+            total, headers = _download_part(url, part_fp, progress, validators)
+        except requests.RequestException as e:
+            error = e   # keep the partial file and resume
+            continue
+        if headers is None:
+            return False    # not modified
+        if total is None or os.path.getsize(part_fp) >= total:
+            break
+        error = 'connection closed early'
+    else:
+        raise DownloadError('download failed: {}'.format(error))
+
+    actual_size = os.path.getsize(part_fp)
+    expected_size = size if size is not None else total
+    if expected_size is not None and actual_size != expected_size:
+        os.remove(part_fp)
+        raise DownloadError('expected {} bytes, got {}'.format(expected_size, actual_size))
+    if sha256 is not None and sha256_of(part_fp) != sha256.lower():
+        os.remove(part_fp)
+        raise DownloadError('sha256 mismatch')
+
+    os.replace(part_fp, str(fp))
+    _write_validators(fp, url, headers)
+    return True
+
+def _download_part(url, part_fp, progress, validators):
+    # appends what's left of url to part_fp, or fetches it in parallel ranges if it's new and large.
+    #  returns (full size or None if unknown, response headers), or (None, None) if not modified
+    done = os.path.getsize(part_fp) if os.path.exists(part_fp) else 0
+    if done:
+        headers = {'Range': 'bytes={}-'.format(done)}
+    else:
+        headers = {}
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'last_modified' in validators:
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    with session().get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status_code == 304:
+            return None, None
+        if response.status_code == 416:
+            # nothing left to send; the partial file is stale or already whole
+            os.remove(part_fp)
+            return _download_part(url, part_fp, progress, validators)
+        response.raise_for_status()
+
+        if response.status_code == 206:
+            total = _content_range_total(response.headers.get('Content-Range', ''))
+        else:
+            done = 0    # server ignored Range; start over
+            length = response.headers.get('Content-Length')
+            total = int(length) if length is not None else None
+            if (total is not None and total >= PARALLEL_MIN_SIZE
+                    and response.headers.get('Accept-Ranges', '').lower() == 'bytes'):
+                # leave this body unread, and get it in pieces instead
+                response.close()
+                _download_ranges(url, part_fp, total, progress)
+                return total, response.headers
+
+        with open(part_fp, 'ab' if done else 'wb') as file:
+            if progress:
+                progress(done, total)
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                file.write(chunk)
+                done += len(chunk)
+                if progress:
+                    progress(done, total)
+    return total, response.headers
+
+def _download_ranges(url, part_fp, total, progress):
+    # fills part_fp with total bytes of url, PARALLEL_RANGES ranges at a time,
+    #  each retried from where it stopped. a range that can't be finished loses the whole file,
+    #  since a partly filled file can't be told apart from a whole one to resume later
+    with open(part_fp, 'wb') as file:
+        file.truncate(total)
+
+    step = -(-total // PARALLEL_RANGES)
+    ranges = [(start, min(start + step, total)) for start in range(0, total, step)]
+    lock = Lock()
+    done = [0]
+    if progress:
+        progress(0, total)
+
+    def on_chunk(n):
+        with lock:
+            done[0] += n
+            if progress:
+                progress(done[0], total)
+
+    try:
+        with ThreadPoolExecutor(len(ranges)) as pool:
+            futures = [pool.submit(_download_range, url, part_fp, start, stop, on_chunk) for start, stop in ranges]
+            written = sum(future.result() for future in futures)
+        if written != total:
+            raise DownloadError('ranges wrote {} of {} bytes'.format(written, total))
+    except Exception:
+        # includes a progress callback raising to cancel
+        os.remove(part_fp)
+        raise
+
+def _download_range(url, part_fp, start, stop, on_chunk):
+    # writes bytes start:stop of url into place in part_fp, resuming after a dropped connection.
+    #  returns the number of bytes written
+    position = start
+    error = None
+    with open(part_fp, 'r+b') as file:
+        for attempt in range(DOWNLOAD_ATTEMPTS):
+            if attempt:
+                time.sleep(RETRY_BACKOFF * 2 ** (attempt-1))
+            headers = {'Range': 'bytes={}-{}'.format(position, stop-1)}
+            try:
+                with session().get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        raise DownloadError('server stopped honoring ranges')
+                    file.seek(position)
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        chunk = chunk[:stop - position]
+                        file.write(chunk)
+                        position += len(chunk)
+                        on_chunk(len(chunk))
+            except requests.RequestException as e:
+                error = e
+            if position >= stop:
+                return position - start
+            error = error or 'connection closed early'
+    raise DownloadError('range {}-{} failed: {}'.format(start, stop-1, error))
+
+def _with_retries(request):
+    # result of request(), tried up to DOWNLOAD_ATTEMPTS times on connection errors
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        if attempt:
+            time.sleep(RETRY_BACKOFF * 2 ** (attempt-1))
+        try:
+            return request()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+    raise DownloadError('request failed: {}'.format(error))
+
+### --- validators, for conditional downloads
+
+def _validators_fp(fp):
+    return str(fp) + '.json'
+
+def _read_validators(fp, url):
+    # ETag and Last-Modified saved from the download of fp, if it came from url
+    try:
+        with open(_validators_fp(fp), 'r') as file:
+            saved = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    if saved.get('url') != url:
+        return {}
+    return {key: saved[key] for key in ('etag', 'last_modified') if saved.get(key)}
+
+def _write_validators(fp, url, headers):
+    saved = {'url': url, 'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+    with open(_validators_fp(fp), 'w') as file:
+        json.dump(saved, file)
+
+def _content_range_total(content_range):
+    # 'bytes 200-999/1000' -> 1000
+    match = re.fullmatch(r'bytes \d+-\d+/(\d+)', content_range.strip())
+    return int(match.group(1)) if match else None
+
+def sha256_of(fp):
+    with open(str(fp), 'rb') as file:
+        return hash_file(file)[0]
+
+def hash_file(file):
+    # (sha256 hex digest, size) of an open binary file, read in chunks
+    sha256 = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b''):
+        sha256.update(chunk)
+        size += len(chunk)
+    return sha256.hexdigest(), size
@@ -1,9 +1,10 @@
 
 from utils import *
 from shared import *
-from updating import MyAppContext
+from updating import MyAppContext, APPLY_UPDATE_ARG, apply_update_main
 
 from threading import Thread
+import multiprocessing
 import re
 import sys
 import os
@@ -25,11 +26,14 @@ class BooksPage(Page, FilterableList):
         book = book_item.text()
         # show content
         if has_chapters(book):
-            # go to chapter screen
-            self.nav.to(ChaptersPage, state=get_num_chapters(book))
+            # go to chapter screen; chapter counts are known before verses load
+            self.open_book(book, ChaptersPage, get_num_chapters(book))
         else:
-            # skip to verses screen
-            self.nav.to(VersesPage, state=data.bible[book]) # or get_bible_content(data.curr_scripture.inc(bok))
+            # skip to verses screen, once there are verses
+            self.nav.when_loaded(lambda: self.open_book(book, VersesPage, scripture_rows(Scripture(book))))
+
+    def open_book(self, book, page, state):
+        self.nav.to(page, state=state)
 
         # widget cleanup
         self.nav.set_title(data.curr_scripture.inc(book, inplace=True))
@@ -42,7 +46,7 @@ class BooksPage(Page, FilterableList):
             QApplication.exit(2)#RESTART_EXIT_CODE)
 
         if ctrl_f_event(event):
-            self.nav.to(SearchResultsPage, state=lambda: iter_verses_in_whole_bible())
+            self.nav.when_loaded(lambda: self.nav.to(SearchResultsPage, state=Scripture()))
             self.searchbox.deactivate()
         else:
             FilterableList.keyPressEvent(self, event)   # this is 0th page; don't need nav back
@@ -61,13 +65,15 @@ class ChaptersPage(Page, FilterableList):
         self.set_items(range(1, num_chapters+1))
 
     def on_chapter_selected(self, chapter_item):
-
         chapter = chapter_item.text()
+        self.nav.when_loaded(lambda: self.open_chapter(chapter))
+
+    def open_chapter(self, chapter):
         data.curr_scripture.inc(chapter, inplace=True)
 
         # show the content
-        verses = get_bible_content(data.curr_scripture)
-        self.nav.to(VersesPage, state=verses)
+        rows = scripture_rows(data.curr_scripture)
+        self.nav.to(VersesPage, state=rows)
 
         # widget cleanup
         self.nav.set_title(str(data.curr_scripture))
@@ -79,14 +85,14 @@ class ChaptersPage(Page, FilterableList):
             self.nav.back()
             self.nav.set_title(data.curr_scripture.dec(inplace=True))
         elif ctrl_f_event(event):
-            # book_scripture = data.curr_scripture
-            self.nav.to(SearchResultsPage, state=lambda: iter_verses_in_book(data.curr_scripture))
+            book_scripture = Scripture(*data.curr_scripture.parts)
+            self.nav.when_loaded(lambda: self.nav.to(SearchResultsPage, state=book_scripture))
             self.searchbox.deactivate()
         else:
             FilterableList.keyPressEvent(self, event)
 
 class VersesPage(Page, QTextEdit, Filterable):
-    '''Formats dict of verses {num: text} into text display.
+    '''Formats a chapter's range of corpus rows into text display.
     Filterable by verse num, isolating and highlighting text.'''
 
     def __init__(self):
@@ -99,13 +105,13 @@ class VersesPage(Page, QTextEdit, Filterable):
         set_font_size(self, 11)
 
     def load_state(self, state):
-        # state = dict of verses in chapter
-        self.verses = state
+        # state = range of rows in chapter
+        self.rows = state
         self.show_all()
 
     def show_all(self):
         # render
-        html = format_to_html(self.verses)
+        html = format_to_html(iter_numbered_verses(self.rows))
         self.set_html(html)
 
     def set_html(self, html):
@@ -118,19 +124,17 @@ class VersesPage(Page, QTextEdit, Filterable):
         # highlight verse, given number
 
         # make sure the verse is there
-        if pattern not in self.verses.keys():
+        row = self.find_row(pattern)
+        if row is None:
             self.show_all()
             return
 
-        n = int(pattern)
-        verse = self.verses[str(n)]
-
         # divide text around verse
-        pre_verses = dict_where_keys(self.verses, lambda k: int(k) < n)
-        main_verse = {n: verse}
-        post_verses = dict_where_keys(self.verses, lambda k: int(k) > n)
+        pre_rows = range(self.rows.start, row)
+        main_rows = range(row, row+1)
+        post_rows = range(row+1, self.rows.stop)
 
-        pre, main, post = (format_to_html(vs) for vs in (pre_verses, main_verse, post_verses))
+        pre, main, post = (format_to_html(iter_numbered_verses(rs)) for rs in (pre_rows, main_rows, post_rows))
 
         html = (
             OPACITY_TEMPLATE.format(pre) +
@@ -160,22 +164,30 @@ class VersesPage(Page, QTextEdit, Filterable):
 
         # allow new highlight from beginning or end
         if pattern == '':
-            last_verse = list(self.verses.keys())[-1]
-            n = (1 if diff == 1 else last_verse)
-
-        # else make sure a verse is already selected
-        elif pattern not in self.verses.keys():
-            return
+            row = (self.rows.start if diff == 1 else self.rows.stop - 1)
 
-        # make sure new verse within bounds
+        # else make sure a verse is already selected,
+        #  and new verse within bounds
         else:
-            n = int(pattern) + diff
-            if str(n) not in self.verses.keys():
+            row = self.find_row(pattern)
+            if row is None or row + diff not in self.rows:
                 return
+            row += diff
 
         # update searchbox, which triggers new highlight filter and updates user
+        n = data.bible.corpus.verse_num(row)
         self.searchbox.activate(str(n))
 
+    def find_row(self, pattern):
+        # row of verse number typed in searchbox, or None if it's not in this chapter
+        if not pattern.isdigit() or not self.rows:
+            return None
+        book, chapter, _ = data.bible.corpus.location(self.rows.start)
+        verse = int(pattern)
+        if METADATA is not None and not METADATA.has_verse(book, chapter, verse):
+            return None     # out of bounds without a lookup
+        return data.bible.corpus.find_row(book, chapter, verse)
+
     def keyPressEvent(self, event):
         keypress = event.key()
 
@@ -194,7 +206,8 @@ class VersesPage(Page, QTextEdit, Filterable):
 
             # search this chapter
             elif keypress == Qt.Key_F:
-                self.nav.to(SearchResultsPage, state=lambda: scriptures_with_verses(data.curr_scripture, self.verses))
+                chapter_scripture = Scripture(*data.curr_scripture.parts)
+                self.nav.to(SearchResultsPage, state=chapter_scripture)
                 self.searchbox.deactivate()
                 self.verticalScrollBar().setValue(0)    # scroll back to top
 
@@ -263,16 +276,23 @@ class SearchResultDelegate(QStyledItemDelegate):
         s.setWidth(0)   # don't allow horiz scroll when there's wide items
         return s
 
-class SearchResultsPage(Page, FilterableList):
-    '''Searches given verses by regex from searchbox and shows matches in list.'''
+class SearchResultsPage(Page, QListView, Filterable):
+    '''Searches verses in given scope by words or regex from searchbox and shows matches in list.'''
 
     def __init__(self):
-        self.default_placeholder_msg = 'search regex:'
+        self.default_placeholder_msg = 'search words or regex:'
         Page.__init__(self)
-        FilterableList.__init__(self, placeholder=self.default_placeholder_msg)
+        QListView.__init__(self)
+        Filterable.__init__(self)
 
+        # list only holds matching rows; items are built as they're scrolled into view
+        self.results = SearchResultsModel(self)
+        self.setModel(self.results)
+        self.setUniformItemSizes(True)
         self.setItemDelegate(SearchResultDelegate(self))    # custom rendering of list item
-        # self.itemActivated.connect(self.on_result_item_selected)
+
+        self.placeholder = EmptyPlaceholderWidget(self, self.default_placeholder_msg)
+        add_grid_child(self, self.placeholder, Qt.AlignCenter, grid=self.layout())
 
         # dummy searchbox serves as visual prompt on empty screen
         #  gives better communication to user
@@ -280,17 +300,15 @@ class SearchResultsPage(Page, FilterableList):
         add_grid_child(self, self.fake_searchbox, Qt.AlignRight | Qt.AlignBottom, grid=self.layout())
         self.fake_searchbox.show()
 
-        # to decrease stalling when doing a large search?
-        # self._thread = None
-        # batches aren't working/helping, maybe because it's a listwidget instead of listview
-        # QListView.setLayoutMode(self, QListView.Batched)
-        # self.setBatchSize(5)
-        # self.setUniformItemSizes(True) # don't think it's helping
-        # maybe implement a list view instead of a list widget?
+        # searches run in background, streaming results back a chunk at a time
+        self.searcher = SearchWorker()
+        self.searcher.found.connect(self.on_results_found)
+        self.searcher.finished.connect(self.on_search_finished)
+        self.generation = None
 
     def load_state(self, state):
-        # state = callable that produces iter of verses in desired scope
-        self.verses_iter_factory = state
+        # state = scripture of desired scope
+        self.rows = scripture_rows(state)
         scope = str(data.curr_scripture)
         self.nav.set_title('Search ' + scope)
         self.show_all()     # trigger empty search display
@@ -298,57 +316,53 @@ class SearchResultsPage(Page, FilterableList):
     def show_all(self):
         # called when searchbox is empty, which means
         # show placeholder and extra searchbox prompt for user.
+        self.searcher.cancel()
+        self.generation = None
         self.clear()
         self.fake_searchbox.show()
         self.placeholder.setText(self.default_placeholder_msg)
 
-    def show_items(self, items):
-        # replaced by custom filter_items, so override and do nothing
-        return
+    def clear(self):
+        self.results.clear()
+        self.placeholder.show()
 
-    # def on_result_item_selected(self, item):
-    #     # callback for list widget selection
-    #     d = item.data(Qt.DisplayRole)
-    #     self.nav.to(SearchedVersePage, state=d['location'])
+    # def on_result_item_selected(self, index):
+    #     # callback for list view selection
+    #     d = index.data(Qt.DisplayRole)
+    #     self.nav.to(SearchedVersePage, state=d['scripture'])
 
     def filter_items(self, search_text):
         # show matches of search in a list
         self.fake_searchbox.hide()  # could be showing if this is first char of search
         self.placeholder.setText(self.default_placeholder_msg)  # could be diff if last search was error
 
-        try:
-            re.compile(search_text)
-        except re.error:
-            self.placeholder.setText('invalid regex')
-            self.clear()
+        # any search still running is now stale
+        self.clear()
+        self.generation = self.searcher.request(search_text, self.rows)
+
+    def on_results_found(self, generation, rows):
+        # next chunk of matches from searcher
+        if generation != self.generation:
             return
+        self.results.extend(rows)
+        self.placeholder.hide()
 
-        self.clear()
+    def on_search_finished(self, generation, error):
+        if generation != self.generation:
+            return
 
-        # items = []
-        for scripture, verse_text in self.verses_iter_factory():
-            match = re.search(search_text, verse_text)
-            if match is not None:
-                item = QListWidgetItem()#self)
-                item.setData(Qt.DisplayRole, {
-                    'scripture': scripture,
-                    'text': verse_text.replace('\n', ' '),
-                })
-                # items.append(item)
-                self.addItem(item)
-        # for i in items:
-        #     self.addItem(i)
-        # print(self.item(100).data(0))
+        if error:
+            self.clear()
+            self.placeholder.setText(error)
 
         # when finished iter and no matches
-        if self.is_empty():
+        elif self.is_empty():
             self.placeholder.setText('no results')
         else:
             self.placeholder.setText('')
 
     def is_empty(self):
-        # return QListWidget.count(self) == 0  # works if you used addItem
-        return self.itemAt(0, 0) is None    # works with just making ListItem(self), not having called addItem
+        return self.results.rowCount() == 0
 
     def keyPressEvent(self, event):
         empty_search = not self.search_is_active() or self.searchbox.text() == ''
@@ -356,8 +370,10 @@ class SearchResultsPage(Page, FilterableList):
             self.nav.back()
             self.nav.set_title(str(data.curr_scripture))
             # self.clear()
+        elif event.key() in FilterableList.NAVIGATION_KEYPRESSES:
+            QListView.keyPressEvent(self, event)
         else:
-            FilterableList.keyPressEvent(self, event)
+            Filterable.keyPressEvent(self, event)
 
 class Main(QWidget):
     # outer window shown; wraps child and restores settings from last session
@@ -387,15 +403,25 @@ class Main(QWidget):
 
 if __name__ == '__main__':
 
+    multiprocessing.freeze_support()    # regex searches run in a child process; see search.py
+
+    if APPLY_UPDATE_ARG in sys.argv:
+        # relaunched by AutoUpdatingApp.apply_update() once the app closes
+        sys.exit(apply_update_main(sys.argv[sys.argv.index(APPLY_UPDATE_ARG)+1:]))
+
     appctxt = MyAppContext()
     set_theme(appctxt.app)
 
-    init_data()
+    # the first page only needs book names, so show it while the corpus loads
+    data.loader = DataLoader()
 
     main = Main(PageManager(BooksPage, ChaptersPage, VersesPage, SearchResultsPage))
     main.show()
     main.setWindowTitle('Bible')
 
+    data.loader.failed.connect(lambda error: main.setWindowTitle('failed to load verses: ' + error))
+    data.loader.start()
+
     # exit_code = appctxt.app.exec_()
     # sys.exit(exit_code)
 
@@ -0,0 +1,93 @@
+'''Precomputed shape of the corpus: books, chapters and verses, without any text.
+
+Written by setup beside the corpus, as json:
+    books           book names in canonical order
+    chapter_counts  per book. chapterless books count as 1 chapter
+    verse_counts    per chapter, every book's chapters back to back
+    last_verses     per chapter, the highest verse number. can be above the count
+                    where a verse is omitted, like Matthew 17:21
+    book_chapter_starts, chapter_starts     cumulative offsets, same as Corpus computes:
+                    first chapter of each book, and first row of each chapter, each with a final end
+
+A couple thousand ints, so it's read at import time for book lists and
+bounds checks, and spares Corpus its pass over every verse id to build the offsets.'''
+
+from array import array
+import json
+import os
+
+VERSION = 1
+
+def write_metadata(fp, corpus, book_names):
+    '''Tabulates an open Corpus. book_names: one per book in the corpus, in order.'''
+    last_verses = []
+    for slot in range(len(corpus.chapter_starts) - 1):
+        rows = range(corpus.chapter_starts[slot], corpus.chapter_starts[slot+1])
+        last_verses.append(corpus.verse_num(rows[-1]) if rows else 0)
+
+    metadata = {
+        'version': VERSION,
+        'num_verses': corpus.num_verses,
+        'books': list(book_names[:corpus.num_books]),
+        'chapter_counts': [corpus.num_chapters(book) for book in range(corpus.num_books)],
+        'verse_counts': [b - a for a, b in zip(corpus.chapter_starts, corpus.chapter_starts[1:])],
+        'last_verses': last_verses,
+        'book_chapter_starts': list(corpus.book_chapter_starts),
+        'chapter_starts': list(corpus.chapter_starts),
+    }
+
+    tmp_fp = str(fp) + '.tmp'
+    with open(tmp_fp, 'w') as file:
+        json.dump(metadata, file, separators=(',', ':'))
+    os.replace(tmp_fp, str(fp))
+
+def load_metadata(fp):
+    # None if setup hasn't written one, or it's from another version
+    try:
+        with open(fp, 'r') as file:
+            return Metadata(json.load(file))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+class Metadata:
+    '''Book, chapter and verse bounds by index, same numbering as Corpus.
+
+    metadata = load_metadata(METADATA_FP)
+    metadata.chapter_counts['Psalms']
+    >>> 150
+    metadata.last_verse(BOOK_INDEXES['Matthew'], 17)
+    >>> 27'''
+
+    def __init__(self, table):
+        if table['version'] != VERSION:
+            raise ValueError('unrecognized metadata version: {}'.format(table['version']))
+        self.num_verses = table['num_verses']
+        self.book_names = table['books']
+        self.chapter_counts = dict(zip(table['books'], table['chapter_counts']))
+        self.verse_counts = table['verse_counts']
+        self.last_verses = table['last_verses']
+        self.book_chapter_starts = array('I', table['book_chapter_starts'])
+        self.chapter_starts = array('I', table['chapter_starts'])
+        if len(self.chapter_starts) != len(self.verse_counts) + 1 or self.chapter_starts[-1] != self.num_verses:
+            raise ValueError('inconsistent metadata')
+
+    def num_chapters(self, book):
+        return self.book_chapter_starts[book+1] - self.book_chapter_starts[book]
+
+    def _slot(self, book, chapter):
+        # index into the per chapter lists, or None if out of bounds
+        if not 0 <= book < len(self.book_names) or not 1 <= chapter <= self.num_chapters(book):
+            return None
+        return self.book_chapter_starts[book] + chapter - 1
+
+    def verse_count(self, book, chapter):
+        slot = self._slot(book, chapter)
+        return 0 if slot is None else self.verse_counts[slot]
+
+    def last_verse(self, book, chapter):
+        slot = self._slot(book, chapter)
+        return 0 if slot is None else self.last_verses[slot]
+
+    def has_verse(self, book, chapter, verse):
+        # in bounds; the verse itself may still be one that's omitted
+        return 1 <= verse <= self.last_verse(book, chapter)
@@ -0,0 +1,282 @@
+'''Compiles searchbox text into a query plan for SearchEngine.
+
+On top of plain words and regex, the searchbox understands a few shortcuts:
+    \\C                  anywhere in the text: match case. otherwise case is ignored
+    "exact words"       whole words only, no prefix matching. can hold punctuation too
+    a AND b, a OR b     verses with both, or either
+    a NOT b             verses with a but not b
+NOT binds tightest, then AND, then OR, same as FTS5. Terms side by side are ANDed.
+Text with any regex chars is a regex instead, searched as typed.
+
+Each plan says how to run it as cheaply as possible:
+an FTS5 match expression when every term is plain words,
+a trigram query to narrow anything else before checking verses,
+and a check per verse that only falls back to re for words and real regexes;
+other literals are a substring find on the lowercased verse.'''
+
+from functools import lru_cache
+import re
+
+from trigrams import plan_all, plan_any, plan_literal, plan_regex
+
+QUERY_CACHE_SIZE = 256
+
+_CASE_FLAG = '\\C'
+_REGEX_SPECIAL_CHARS = set('.^$*+?{}[]\\|()')
+_OPERATORS = ('AND', 'OR', 'NOT')
+# a quoted phrase (maybe still being typed), an operator, or a bare word
+_TOKEN_PATTERN = re.compile(r'"([^"]*)("?)|(\S+)')
+_WORD_CHARS_PATTERN = re.compile(r"[\w' ]*")
+_TOKENS_PATTERN = re.compile(r'\w+')
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def compile_query(search_text):
+    '''Plan for search_text, cached since the same queries come back while typing.
+    Raises re.error for an invalid regex.
+
+    compile_query('love NOT hate').fts
+    >>> '("love" NOT "hate"*)' '''
+    return Query(search_text)
+
+class Query:
+    '''A compiled search.
+
+    kind:   'words', 'literal', 'regex', or 'boolean' when terms are combined
+    fts:    FTS5 match expression giving every match, or None if FTS can't answer it.
+            with case_sensitive, it's a superset and matches() has to confirm each row
+    trigrams:   trigram query every match satisfies, see trigrams.py
+    regex:  the compiled pattern when kind is 'regex', which may need a time limit
+    matches(text):  whether a verse matches'''
+
+    def __init__(self, search_text):
+        self.text = search_text
+        self.case_sensitive = _CASE_FLAG in search_text
+        self.body = search_text.replace(_CASE_FLAG, '')
+
+        self.regex = None
+        if any(c in _REGEX_SPECIAL_CHARS for c in self.body):
+            self.kind = 'regex'
+            self.tree = ('term', _RegexTerm(self.body, self.case_sensitive))
+            self.regex = self.tree[1].regex
+        else:
+            self.tree = _parse(self.body, self.case_sensitive)
+            self.kind = self.tree[1].kind if self.tree[0] == 'term' else 'boolean'
+
+        self.fts = _fts(self.tree, self.case_sensitive)
+        self.trigrams = _trigrams(self.tree)
+
+    def matches(self, text):
+        # lowercased once per verse, for every term to check against
+        haystack = text if self.case_sensitive or self.kind == 'regex' else text.lower()
+        return _matches(self.tree, text, haystack)
+
+    def refines(self, old):
+        # True if every verse this matches also matches old, so only old's results need checking.
+        #  compared term by term, since typing can turn a word into an operator that widens the query
+        if self.case_sensitive != old.case_sensitive:
+            return False
+        return _refines(self.tree, old.tree)
+
+    def __repr__(self):
+        return 'Query({!r})'.format(self.text)
+
+def is_literal_extension(old_pattern, new_pattern):
+    # True when new_pattern is old_pattern plus plain chars, so any verse it matches also matches old.
+    #  a trailing backslash-digit could turn into a different escape, eg \1 -> \10
+    if not new_pattern.startswith(old_pattern) or re.search(r'\\[0-9]*$', old_pattern):
+        return False
+    suffix = new_pattern[len(old_pattern):]
+    return not any(c in _REGEX_SPECIAL_CHARS for c in suffix)
+
+### --- terms
+
+class _WordsTerm:
+    '''Whole words in order, like an FTS5 phrase. The last word is a prefix while still being typed.'''
+    kind = 'words'
+
+    def __init__(self, text, prefix, case_sensitive):
+        self.words = _TOKENS_PATTERN.findall(text if case_sensitive else text.lower())
+        self.prefix = prefix
+        # anything between words, like FTS5's tokenizer
+        self.regex = re.compile(r'\b' + r'\W+'.join(self.words) + ('' if prefix else r'\b'))
+
+    def fts(self):
+        phrase = '"{}"'.format(' '.join(self.words))
+        return phrase + '*' if self.prefix else phrase
+
+    def trigrams(self):
+        return plan_all([plan_literal(word) for word in self.words])
+
+    def refines(self, old):
+        if old.kind != 'words':
+            return False
+        n = len(old.words)
+        if len(self.words) < n or self.words[:n-1] != old.words[:n-1]:
+            return False
+        if old.prefix:
+            return self.words[n-1].startswith(old.words[-1])
+        # old's last word is whole; so is this one, unless more words follow it
+        return self.words[n-1] == old.words[-1] and (len(self.words) > n or not self.prefix)
+
+    def matches(self, text, haystack):
+        return self.regex.search(haystack) is not None
+
+class _LiteralTerm:
+    '''Exact text with punctuation, which FTS would ignore.'''
+    kind = 'literal'
+
+    def __init__(self, text, case_sensitive):
+        self.needle = text if case_sensitive else text.lower()
+
+    def fts(self):
+        return None
+
+    def trigrams(self):
+        return plan_literal(self.needle)
+
+    def refines(self, old):
+        return old.kind == 'literal' and old.needle in self.needle
+
+    def matches(self, text, haystack):
+        return self.needle in haystack
+
+class _RegexTerm:
+    kind = 'regex'
+
+    def __init__(self, pattern, case_sensitive):
+        self.pattern = pattern
+        self.regex = re.compile(pattern, 0 if case_sensitive else re.IGNORECASE)
+
+    def fts(self):
+        return None
+
+    def trigrams(self):
+        return plan_regex(self.pattern)
+
+    def refines(self, old):
+        return old.kind == 'regex' and is_literal_extension(old.pattern, self.pattern)
+
+    def matches(self, text, haystack):
+        return self.regex.search(text) is not None
+
+def _term(text, prefix, case_sensitive):
+    # words if FTS could find it, else a literal
+    if _WORD_CHARS_PATTERN.fullmatch(text) and _TOKENS_PATTERN.search(text):
+        return _WordsTerm(text, prefix, case_sensitive)
+    return _LiteralTerm(text, case_sensitive)
+
+### --- parsing
+
+def _parse(body, case_sensitive):
+    # tree of ('term', term) and (op, left, right) nodes
+    items = []  # terms and operators, in order
+    words = []  # bare words not yet made into a term
+
+    def flush(prefix=False):
+        if words:
+            items.append(_term(' '.join(words), prefix, case_sensitive))
+            words.clear()
+
+    for match in _TOKEN_PATTERN.finditer(body):
+        quoted, closing, bare = match.groups()
+        if bare in _OPERATORS:
+            flush()
+            items.append(bare)
+        elif bare is not None:
+            words.append(bare)
+        else:
+            flush()
+            if quoted.strip():
+                # still a prefix until the closing quote is typed
+                items.append(_term(quoted, not closing, case_sensitive))
+    flush(prefix=not body.endswith(' '))
+
+    tree = _parse_or(_drop_stray_operators(items))
+    if tree is None:
+        # nothing but operators and empty quotes; just look for the text itself
+        return ('term', _term(body.strip(), not body.endswith(' '), case_sensitive))
+    return tree
+
+def _drop_stray_operators(items):
+    # operators while still being typed, like 'love AND', have nothing to combine.
+    #  terms side by side get an AND between them
+    result = []
+    for item in items:
+        if isinstance(item, str):
+            if result and not isinstance(result[-1], str):
+                result.append(item)
+        else:
+            if result and not isinstance(result[-1], str):
+                result.append('AND')
+            result.append(item)
+    if result and isinstance(result[-1], str):
+        result.pop()
+    return result
+
+def _parse_or(items):
+    return _parse_binary(items, 'OR', _parse_and)
+
+def _parse_and(items):
+    return _parse_binary(items, 'AND', _parse_not)
+
+def _parse_not(items):
+    return _parse_binary(items, 'NOT', lambda items: ('term', items[0]) if items else None)
+
+def _parse_binary(items, operator, parse_operand):
+    # left associative: a OP b OP c -> ((a OP b) OP c)
+    tree = None
+    start = 0
+    for i in range(len(items) + 1):
+        if i == len(items) or items[i] == operator:
+            operand = parse_operand(items[start:i])
+            tree = operand if tree is None else (operator.lower(), tree, operand)
+            start = i + 1
+    return tree
+
+### --- executors
+
+def _fts(tree, case_sensitive):
+    # FTS5 is case insensitive, so a case sensitive query drops NOT terms;
+    #  the rows they would exclude are then weeded out by matches()
+    op = tree[0]
+    if op == 'term':
+        return tree[1].fts()
+    left = _fts(tree[1], case_sensitive)
+    if op == 'not' and case_sensitive:
+        return left
+    right = _fts(tree[2], case_sensitive)
+    if left is None or right is None:
+        return None
+    return '({} {} {})'.format(left, op.upper(), right)
+
+def _trigrams(tree):
+    op = tree[0]
+    if op == 'term':
+        return tree[1].trigrams()
+    if op == 'and':
+        return plan_all([_trigrams(tree[1]), _trigrams(tree[2])])
+    if op == 'or':
+        return plan_any([_trigrams(tree[1]), _trigrams(tree[2])])
+    return _trigrams(tree[1])   # 'not' rules nothing in
+
+def _refines(tree, old):
+    # True if tree matches a subset of what old does
+    op = tree[0]
+    if op != old[0]:
+        return False
+    if op == 'term':
+        return tree[1].refines(old[1])
+    if op == 'not':
+        # fewer results means excluding more, so the NOT term has to widen instead
+        return _refines(tree[1], old[1]) and _refines(old[2], tree[2])
+    return _refines(tree[1], old[1]) and _refines(tree[2], old[2])
+
+def _matches(tree, text, haystack):
+    op = tree[0]
+    if op == 'term':
+        return tree[1].matches(text, haystack)
+    if op == 'and':
+        return _matches(tree[1], text, haystack) and _matches(tree[2], text, haystack)
+    if op == 'or':
+        return _matches(tree[1], text, haystack) or _matches(tree[2], text, haystack)
+    return _matches(tree[1], text, haystack) and not _matches(tree[2], text, haystack)
@@ -0,0 +1,86 @@
+'''Fast RTF to plaintext, for the book files in the NWT download.
+
+Same output as striprtf's rtf_to_text, which setup used to run on every book,
+but plain text is taken a run at a time instead of one regex match per char.
+The book files are mostly plain text between a few control words, so that's most of the work.
+Anything unexpected, like unbalanced braces, falls back to striprtf.'''
+
+from striprtf.striprtf import rtf_to_text as striprtf_to_text, destinations, specialchars
+
+import re
+
+# same tokens as striprtf, except runs of plain text are one token
+_TOKEN_PATTERN = re.compile(
+    r"\\([a-z]{1,32})(-?\d{1,10})?[ ]?|\\'([0-9a-f]{2})|\\([^a-z])|([{}])|[\r\n]+|([^\\{}\r\n]+)|(\\)",
+    re.I,
+)
+_ESCAPED_CHARS = {'~': '\xa0', '{': '{', '}': '}', '\\': '\\', '\n': '\n', '\r': '\r'}
+
+class _Unexpected(Exception):
+    pass
+
+def rtf_to_text(text):
+    try:
+        return _convert(text)
+    except _Unexpected:
+        return striprtf_to_text(text)
+
+def _convert(text):
+    stack = []
+    ignorable = False   # inside a destination, like the font table
+    ucskip = 1          # chars after a \u that are its ascii fallback
+    curskip = 0         # fallback chars still to skip
+    out = []
+
+    for match in _TOKEN_PATTERN.finditer(text):
+        word, arg, hex, char, brace, run, backslash = match.groups()
+        if run is not None:
+            if curskip:
+                skipped = min(curskip, len(run))
+                run = run[skipped:]
+                curskip -= skipped
+            if not ignorable:
+                out.append(run)
+        elif word is not None:
+            curskip = 0
+            if word in destinations:
+                ignorable = True
+            elif ignorable:
+                pass
+            elif word in specialchars:
+                out.append(specialchars[word])
+            elif word == 'uc':
+                ucskip = int(arg)
+            elif word == 'u':
+                if arg is not None:
+                    c = int(arg)
+                    out.append(chr(c + 0x10000 if c < 0 else c))
+                curskip = ucskip
+        elif brace is not None:
+            curskip = 0
+            if brace == '{':
+                stack.append((ucskip, ignorable))
+            elif not stack:
+                raise _Unexpected   # striprtf has its own recovery for this
+            else:
+                ucskip, ignorable = stack.pop()
+        elif hex is not None:
+            if curskip:
+                curskip -= 1
+            elif not ignorable:
+                out.append(chr(int(hex, 16)))
+        elif char is not None:
+            curskip = 0
+            if char == '*':
+                ignorable = True
+            elif char in _ESCAPED_CHARS and not ignorable:
+                out.append(_ESCAPED_CHARS[char])
+        elif backslash is not None:
+            # lone backslash at the very end
+            if curskip:
+                curskip -= 1
+            elif not ignorable:
+                out.append(backslash)
+        # else newlines in the rtf source, which mean nothing
+
+    return ''.join(out)
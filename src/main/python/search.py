@@ -0,0 +1,284 @@
+'''Verse searching for SearchResultsPage.
+
+Searchbox text is compiled to a plan by query.py. Word, prefix and phrase queries,
+alone or combined, are answered by a sqlite FTS5 index built during setup.
+Anything else is narrowed by the trigram index when possible and confirmed verse by verse.'''
+
+from bisect import bisect_left
+from itertools import islice
+import multiprocessing
+import os
+import sqlite3
+
+from corpus import Corpus
+from query import compile_query
+
+def build_search_db(fp, corpus):
+    '''Writes an FTS5 table of every verse, rowid being the verse's corpus row.
+    Searches are scoped by rowid range, which FTS5 narrows with its index.
+    Raises sqlite3.OperationalError if this sqlite was built without FTS5.'''
+    tmp_fp = str(fp) + '.tmp'
+    if os.path.exists(tmp_fp):
+        os.remove(tmp_fp)
+
+    db = sqlite3.connect(tmp_fp)
+    try:
+        db.execute('CREATE VIRTUAL TABLE verses USING fts5(text)')
+        rows = range(corpus.num_verses)
+        db.executemany(
+            'INSERT INTO verses(rowid, text) VALUES (?, ?)',
+            zip(rows, corpus.texts(rows))
+        )
+        db.execute("INSERT INTO verses(verses) VALUES ('optimize')")
+        db.commit()
+    finally:
+        db.close()
+    os.replace(tmp_fp, str(fp))
+
+def open_search_db(fp):
+    # None when setup couldn't build one; searches then all scan verses instead
+    if not os.path.exists(str(fp)):
+        return None
+    try:
+        # read-only, and only ever used by one search thread at a time
+        db = sqlite3.connect('file:{}?mode=ro'.format(fp), uri=True, check_same_thread=False)
+        db.execute('SELECT rowid FROM verses LIMIT 1')
+        return db
+    except sqlite3.Error:
+        return None
+
+def fts_query(search_text):
+    '''FTS5 match expression for search_text, or None if it isn't plain words.
+
+    'in the beg'            -> '"in the beg"*'  (phrase, last word as a prefix while typing)
+    '"in the beginning"'    -> '"in the beginning"'  (exact phrase)
+    'love OR hope'          -> '("love" OR "hope"*)'
+    'in.*beg'               -> None'''
+    return compile_query(search_text).fts
+
+class SearchTooExpensive(Exception):
+    '''A regex took longer than its time limit and was stopped.'''
+
+class RegexProcess:
+    '''Child process that runs regexes over the corpus.
+
+    re can't be interrupted, and a pattern like (a+)+$ can backtrack for ages
+    holding the GIL. Out here it can be killed instead of hanging the app:
+    if a chunk of verses takes longer than time_limit seconds,
+    the process is killed, SearchTooExpensive is raised, and the next search starts a new one.
+
+    process = RegexProcess(CORPUS_FP, 2)
+    for rows in process.iter_search(re.compile('Jehovah.*said'), range(1000)):
+        ..'''
+
+    CHUNK_SIZE = 1000
+
+    def __init__(self, corpus_fp, time_limit):
+        self.corpus_fp = str(corpus_fp)
+        self.time_limit = time_limit
+        self._process = None
+        self._conn = None
+        self._request_id = 0
+
+    def iter_search(self, regex, rows):
+        # rows: range or sorted list of rows to check. yields matching rows a chunk at a time
+        self._request_id += 1
+        request_id = self._request_id
+        finished = False
+        try:
+            self._start()
+            self._conn.send((request_id, regex, rows))
+            while True:
+                if not self._conn.poll(self.time_limit):
+                    raise SearchTooExpensive(regex.pattern)
+                reply_id, chunk = self._conn.recv()
+                if reply_id != request_id:
+                    continue    # left over from a search given up on
+                if chunk is None:
+                    finished = True
+                    return
+                yield chunk
+        except (EOFError, OSError):
+            # process died or never started, eg out of memory on a huge pattern
+            finished = True
+            self.close()
+            raise SearchTooExpensive(regex.pattern)
+        except SearchTooExpensive:
+            finished = True
+            self.close()
+            raise
+        finally:
+            if not finished:
+                self._cancel()
+
+    def _cancel(self):
+        # caller gave up partway; stop scanning
+        try:
+            self._conn.send(None)
+        except OSError:
+            self.close()
+
+    def _start(self):
+        if self._process is not None:
+            return
+        # spawn, since forking a process with Qt threads running isn't safe
+        context = multiprocessing.get_context('spawn')
+        self._conn, child_conn = context.Pipe()
+        process = context.Process(target=_run_regexes, args=(child_conn, self.corpus_fp, self.CHUNK_SIZE), daemon=True)
+        try:
+            process.start()
+        except OSError:
+            self._conn.close()
+            raise
+        finally:
+            child_conn.close()
+        self._process = process     # only once started, so close() can stop it
+        self._conn.recv()   # ready; startup doesn't count against the time limit
+
+    def close(self):
+        if self._process is None:
+            return
+        self._process.terminate()
+        self._process.join()
+        self._conn.close()
+        self._process = None
+        self._conn = None
+
+def _run_regexes(conn, corpus_fp, chunk_size):
+    # main loop of RegexProcess's child
+    corpus = Corpus(corpus_fp)
+    conn.send('ready')
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return  # app closed
+        if request is None:
+            continue
+        request_id, regex, rows = request
+        for start in range(0, len(rows), chunk_size):
+            if conn.poll():
+                break   # cancelled, or a newer search is waiting
+            chunk = rows[start : start+chunk_size]
+            texts = corpus.texts(chunk) if isinstance(chunk, range) else map(corpus.text, chunk)
+            conn.send((request_id, [row for row, text in zip(chunk, texts) if regex.search(text)]))
+        else:
+            conn.send((request_id, None))
+
+class SearchEngine:
+    '''Runs a searchbox query over a scope of the bible, returning matching corpus rows in order.
+
+    Keeps a short history of results while the query is being typed:
+    a query that only adds to the last one re-checks just the last results,
+    and backspacing to an earlier query reuses its results.
+
+    engine.search('love', corpus.book_rows(42))
+    >>> [26510, 26533, ..]'''
+
+    HISTORY_SIZE = 32
+    CHUNK_SIZE = 1000
+
+    def __init__(self, bible, db=None, trigrams=None, regex_process=None):
+        # regex_process: RegexProcess to run regexes in, else they run right here with no time limit
+        self.bible = bible
+        self.db = db
+        self.trigrams = trigrams
+        self.regex_process = regex_process
+        self._scope = None
+        self._history = []  # [(search_text, rows)], each search_text a prefix of the next
+
+    def search(self, search_text, rows):
+        # rows: range of corpus rows in scope
+        # raises re.error for an invalid regex, or SearchTooExpensive
+        results = []
+        for chunk in self.iter_search(search_text, rows):
+            results.extend(chunk)
+        return results
+
+    def iter_search(self, search_text, rows):
+        '''Same as search(), but yields matching rows in chunks as the scope is scanned,
+        so a caller can show results early or give up partway.
+        Chunks may be empty. Results are only remembered once iterated to the end.'''
+        if self._scope != rows:
+            self._scope = rows
+            self._history.clear()
+
+        # drop anything that was backspaced away
+        while self._history and not search_text.startswith(self._history[-1][0]):
+            self._history.pop()
+
+        if self._history and self._history[-1][0] == search_text:
+            yield self._history[-1][1]
+            return
+
+        query = compile_query(search_text)    # raises before anything is yielded
+        if self._history and self._refines(compile_query(self._history[-1][0]), query):
+            chunks = self._iter_search(query, rows, within=self._history[-1][1])
+        else:
+            chunks = self._iter_search(query, rows)
+
+        results = []
+        for chunk in chunks:
+            results.extend(chunk)
+            yield chunk
+
+        self._history.append((search_text, results))
+        del self._history[:-self.HISTORY_SIZE]
+
+    def _uses_fts(self, query):
+        return self.db is not None and query.fts is not None
+
+    def _refines(self, old_query, new_query):
+        # True if new_query only needs checking against old_query's results.
+        #  fts queries never do: a fresh indexed query beats re-checking rows one by one in sqlite
+        if self._uses_fts(old_query) or self._uses_fts(new_query):
+            return False
+        return new_query.refines(old_query)
+
+    def _iter_search(self, query, rows, within=None):
+        # within: sorted rows to re-check instead of the whole scope
+        if self._uses_fts(query):
+            return self._iter_fts(query, rows)
+        return self._iter_scan(query, rows, within)
+
+    def _iter_fts(self, query, rows):
+        # rowid is the corpus row, and a scope is always one range of them
+        sql = 'SELECT rowid FROM verses WHERE verses MATCH ? AND rowid >= ? AND rowid < ? ORDER BY rowid'
+        cursor = self.db.execute(sql, (query.fts, rows.start, rows.stop))
+        batch = cursor.fetchmany(self.CHUNK_SIZE)
+        while batch:
+            if query.case_sensitive:
+                # fts ignores case, so it only gave candidates
+                yield [row for (row,) in batch if query.matches(self.bible.text(row))]
+            else:
+                yield [row for (row,) in batch]
+            batch = cursor.fetchmany(self.CHUNK_SIZE)
+
+    def _iter_scan(self, query, rows, within=None):
+        candidates = within
+        if candidates is None and self.trigrams is not None:
+            candidates = self.trigrams.query(query.trigrams)
+
+        if candidates is not None:
+            lo = bisect_left(candidates, rows.start)
+            hi = bisect_left(candidates, rows.stop)
+            candidates = candidates[lo:hi]
+
+        if query.regex is not None and self.regex_process is not None:
+            return self.regex_process.iter_search(query.regex, rows if candidates is None else candidates)
+
+        if candidates is None:
+            # nothing to narrow by; check every verse in scope
+            verses = self.bible.iter_verses(rows)
+        else:
+            verses = ((row, self.bible.text(row)) for row in candidates)
+
+        return self._iter_matching(query, verses)
+
+    def _iter_matching(self, query, verses):
+        # chunked by verses checked, not matches found, so callers hear back regularly
+        while True:
+            batch = list(islice(verses, self.CHUNK_SIZE))
+            if not batch:
+                return
+            yield [row for row, text in batch if query.matches(text)]
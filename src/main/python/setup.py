@@ -1,17 +1,26 @@
 '''Setup (one-time) to prepare data for gui.'''
 
-import constants
+import shared
+from corpus import Corpus, write_corpus, read_parsed_book, iter_parsed_chapters
+from metadata import write_metadata
+from search import build_search_db
+from trigrams import build_trigram_index, update_trigram_index
 
 # import sys
 # sys.path.insert(0, '../env/Lib/site-packages')
-from striprtf.striprtf import rtf_to_text
-import requests
+from rtf import rtf_to_text
+from downloads import download, DownloadError, sha256_of
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+import argparse
 import glob
-import re
 import json
-from io import BytesIO
-from zipfile import ZipFile
+import os
+import re
+from zipfile import ZipFile, BadZipFile
+import sqlite3
+import time
 # from time import sleep
 
 # LOCAL_RTF_FILEPATHS = {
@@ -22,10 +31,11 @@ from zipfile import ZipFile
 #            glob.glob('../data/nwt_E_new.rtf/nwt_[0-9][0-9]_*'),)
 # }
 CHAPTER_PATTERN = re.compile(r'\n(?:Chapter|Psalm) ([0-9]+)\n(?=1)') # probably best
-VERSE_PATTERN = re.compile(r'([0-9]+)\xa0')
+HEADING_PATTERN = re.compile(r'^(?:Chapter|Psalm) ([0-9]+)$', re.M)    # on a line of its own
 # CHAPTERLESS_PATTERN = re.compile(r'\n\n(?=1\xa0)') # for Jude and such
 CHAPTERLESS_PATTERN = re.compile(r'\n(?=1\xa0)') # for Jude and such
 BIBLE_URL = 'https://download-a.akamaihd.net/files/media_publication/57/nwt_E.rtf.zip'
+MANIFEST_VERSION = 2
 
 # def test():
 #
@@ -50,17 +60,63 @@ BIBLE_URL = 'https://download-a.akamaihd.net/files/media_publication/57/nwt_E.rt
 #         return read_rtf_to_text(fp)
 
 
-def main():
-    bible_zip = fetch_content()
-    parse_and_write(iter_books(bible_zip))
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Download and prepare the bible text for the app.')
+    parser.add_argument('--force', action='store_true',
+                        help='download and rebuild even if the source is unchanged')
+    parser.add_argument('--report', nargs='?', const='table', choices=['table', 'json'],
+                        help='time each stage and book, then print it as a table (default) or json')
+    args = parser.parse_args(argv)
+
+    report = SetupReport()
+    updated = False
+    for name in main_progress_iterator(force=args.force, report=report):
+        if args.report != 'json':   # keep json output parseable
+            print(name)
+        updated = True
+    if not updated and args.report != 'json':
+        print('already up to date')
+
+    if args.report == 'json':
+        print(json.dumps(report.to_json(), indent=2))
+    elif args.report == 'table':
+        print(report.format_table())
+
+def main_progress_iterator(download_progress=None, force=False, report=None):
+    '''Downloads, parses, and writes everything, yielding each book name as it's parsed.
+    Books finish in any order. download_progress is passed on to download().
+    Yields nothing if the source hasn't changed since the last setup, unless force.
+    Only books that changed are parsed again; the rest are read back from the corpus.
+    report: SetupReport to record the time and bytes of each stage in.'''
+    report = report if report is not None else SetupReport()
 
-def main_progress_iterator():
-    bible_zip = fetch_content()
-    for name, plaintext in zip(constants.BOOK_NAMES,
-                               iter_books(bible_zip)):
-        fp = constants.BOOK_FP_TEMPLATE.format(name)
-        save_as_json(parse_book(plaintext), fp)
-        yield name
+    with report.stage('download') as stage:
+        bible_zip = fetch_content(download_progress, force)
+        if bible_zip is not None and bible_zip.filename:
+            stage['bytes_out'] = os.path.getsize(bible_zip.filename)
+    if bible_zip is None:
+        return
+    fps = book_filenames(bible_zip)
+    signatures = zip_signatures(bible_zip, fps)
+    manifest = None
+    parsed, old_rows = [None] * len(fps), [None] * len(fps)
+    if not force:
+        with report.stage('reuse unchanged books'):
+            manifest = read_manifest()
+            parsed, old_rows = reuse_unchanged_books(fps, signatures, manifest)
+
+    todo = [i for i, book in enumerate(parsed) if book is None]
+    if not todo and outputs_are_complete(manifest):
+        return
+    # not shared.BOOK_NAMES, which comes from the metadata being replaced
+    book_names = list(shared.read_chapter_counts())
+    for i, book in iter_parsed_books(bible_zip, [fps[i] for i in todo], report, [book_names[i] for i in todo]):
+        parsed[todo[i]] = book
+        yield book_names[todo[i]]
+    # outputs are only trusted again once they've all been written
+    remove_manifest()
+    built = write_outputs(parsed, old_rows, book_names, report)
+    write_manifest(signatures, built)
 
     # for name in constants.BOOK_NAMES:
     #     # sleep(1)
@@ -68,30 +124,185 @@ def main_progress_iterator():
     #         i += 1
     #     yield name
 
-def fetch_content():
-    '''Returns zip download from JW url.'''
-    response = requests.get(BIBLE_URL)
-    filelike = BytesIO(response.content)
-    return ZipFile(filelike)
+def fetch_content(progress=None, force=False):
+    '''Returns zip download from JW url, checked before anything is extracted.
+    Returns None if it's unchanged since the last setup, which already parsed it.'''
+    # only worth asking if the last download made it all the way to a corpus this version can read
+    conditional = not force and outputs_are_current()
+    if not download(BIBLE_URL, shared.BIBLE_ZIP_FP, progress, conditional=conditional):
+        return None
+    try:
+        bible_zip = ZipFile(str(shared.BIBLE_ZIP_FP))
+    except BadZipFile as e:
+        os.remove(str(shared.BIBLE_ZIP_FP))
+        raise DownloadError('corrupt download: {}'.format(e))
+    bad_member = bible_zip.testzip()
+    if bad_member is not None:
+        bible_zip.close()
+        os.remove(str(shared.BIBLE_ZIP_FP))
+        raise DownloadError('corrupt download, bad crc: {}'.format(bad_member))
+    return bible_zip
+
+def outputs_are_current():
+    # the last setup finished, and in the formats the app reads now
+    if not outputs_are_complete(read_manifest()):
+        return False
+    try:
+        Corpus(shared.CORPUS_FP).close()
+        return True
+    except (OSError, ValueError):
+        return False
+
+def outputs_are_complete(manifest):
+    # every output the manifest vouches for is there, and each index is from the current corpus
+    if manifest is None or not shared.METADATA_FP.exists() or not shared.TRIGRAM_FP.exists():
+        return False
+    if manifest['trigram index'] != manifest['corpus']:
+        return False
+    if manifest['search index'] is None:
+        return True     # skipped, eg sqlite without fts5
+    return manifest['search index'] == manifest['corpus'] and shared.SEARCH_DB_FP.exists()
+
+def zip_signatures(zip, fps):
+    # {filename: [crc32, size]}, straight from the zip directory without reading anything
+    infos = {info.filename: info for info in zip.filelist}
+    return {fp: [infos[fp].CRC, infos[fp].file_size] for fp in fps}
 
-def parse_and_write(books):
-    '''Write each book's parsed content to file.'''
-    for name, plaintext in zip(constants.BOOK_NAMES, books):
-        fp = constants.BOOK_FP_TEMPLATE.format(name)
+def read_manifest():
+    '''The manifest of the last setup that finished, if the corpus is still the one it wrote:
+        books   {filename: [crc32, size]} of each book in the zip, see zip_signatures()
+        corpus  sha256 of the corpus
+        trigram index, search index     sha256 of the corpus each was built from, None if skipped
+    None if there isn't one, or it's from an older version or a setup that died partway.'''
+    try:
+        with open(str(shared.MANIFEST_FP), 'r') as file:
+            manifest = json.load(file)
+        if manifest.get('version') != MANIFEST_VERSION or manifest['corpus'] != sha256_of(shared.CORPUS_FP):
+            return None
+        return manifest
+    except (OSError, ValueError, KeyError, AttributeError):
+        return None
 
-        print(name)
+def write_manifest(signatures, built):
+    # built: what write_outputs() returned
+    manifest = dict(built, version=MANIFEST_VERSION, books=signatures)
+    tmp_fp = str(shared.MANIFEST_FP) + '.tmp'
+    with open(tmp_fp, 'w') as file:
+        json.dump(manifest, file, indent=0)
+    os.replace(tmp_fp, str(shared.MANIFEST_FP))
 
-        save_as_json(parse_book(plaintext), fp)
+def remove_manifest():
+    try:
+        os.remove(str(shared.MANIFEST_FP))
+    except FileNotFoundError:
+        pass
 
-def iter_books(zip):
-    '''Returns iterator of book files as strings.'''
+def reuse_unchanged_books(fps, signatures, manifest):
+    '''For books whose zip member is the same as at the last setup,
+    returns them parsed again from the current corpus, and their rows in it. None for the rest.
+    manifest: from read_manifest(), so it's known to describe the current corpus.'''
+    if manifest is None:
+        return [None] * len(fps), [None] * len(fps)
+    try:
+        corpus = Corpus(shared.CORPUS_FP)
+    except (OSError, ValueError):
+        return [None] * len(fps), [None] * len(fps)
+    try:
+        if corpus.num_books != len(fps):
+            return [None] * len(fps), [None] * len(fps)
+        unchanged = [manifest['books'].get(fp) == signatures[fp] for fp in fps]
+        parsed = [read_parsed_book(corpus, i) if same else None for i, same in enumerate(unchanged)]
+        # trigram postings can only be carried over from an index of this same corpus
+        patchable = manifest['trigram index'] == manifest['corpus']
+        old_rows = [corpus.book_rows(i) if same and patchable else None for i, same in enumerate(unchanged)]
+        return parsed, old_rows
+    finally:
+        corpus.close()     # so the corpus file can be replaced
+
+def write_outputs(parsed_books, old_rows=None, book_names=None, report=None):
+    '''Write the packed corpus and its metadata table, then index it for searching.
+    old_rows: per book, its rows in the previous corpus if unchanged since, else None.
+    Those books keep their trigram postings instead of being indexed again.
+    book_names: for the metadata, default the ones in chapter_counts.csv.
+    Returns the sha256 of the corpus, and of the corpus each index was built from, for the manifest.'''
+    report = report if report is not None else SetupReport()
+    text_size = sum(len(text.encode('utf-8'))
+                    for book in parsed_books
+                    for _, verses in iter_parsed_chapters(book)
+                    for text in verses.values())
+
+    with report.stage('write corpus', text_size) as stage:
+        write_corpus(shared.CORPUS_FP, parsed_books)
+        stage['bytes_out'] = os.path.getsize(str(shared.CORPUS_FP))
+    corpus_sha256 = sha256_of(shared.CORPUS_FP)
+    built = {'corpus': corpus_sha256, 'trigram index': None, 'search index': None}
+
+    corpus = Corpus(shared.CORPUS_FP)
+    try:
+        with report.stage('write metadata') as stage:
+            write_metadata(shared.METADATA_FP, corpus, book_names or list(shared.read_chapter_counts()))
+            stage['bytes_out'] = os.path.getsize(str(shared.METADATA_FP))
+        kept = [(corpus.book_rows(i), rows.start) for i, rows in enumerate(old_rows or []) if rows is not None]
+        with report.stage('trigram index', text_size) as stage:
+            if kept:
+                update_trigram_index(shared.TRIGRAM_FP, corpus, kept)
+            else:
+                build_trigram_index(shared.TRIGRAM_FP, corpus)
+            stage['bytes_out'] = os.path.getsize(str(shared.TRIGRAM_FP))
+        built['trigram index'] = corpus_sha256
+        with report.stage('search index', text_size) as stage:
+            build_search_db(shared.SEARCH_DB_FP, corpus)
+            stage['bytes_out'] = os.path.getsize(str(shared.SEARCH_DB_FP))
+        built['search index'] = corpus_sha256
+    except sqlite3.OperationalError as e:
+        # eg. sqlite without fts5; app falls back to regex searching
+        print('skipped search index:', e)
+    finally:
+        corpus.close()
+    return built
+
+def book_filenames(zip):
+    '''Returns book files in the zip, in BOOK_NAMES order.'''
     # remove foreword, appendixes, etc
     fps = [f.filename for f in zip.filelist
            if re.match(r'nwt_[\d]{2}_[\w]+_E.rtf', f.filename)]
-    for fp in sorted(fps):  # could be in any order
-        book_rtf_bytes = zip.read(fp)
-        book_rtf_str = book_rtf_bytes.decode('utf-8')
-        yield rtf_to_text(book_rtf_str)
+    return sorted(fps)  # could be in any order
+
+def iter_parsed_books(zip, fps, report=None, names=None):
+    '''Parses books across a process pool, one per core.
+    Yields (index in fps, parsed book) as each one finishes, in any order.
+    names: what to call each book in the report, default its file name.'''
+    report = report if report is not None else SetupReport()
+    names = names or fps
+
+    with report.stage('unzip', sum(zip.getinfo(fp).compress_size for fp in fps)) as stage:
+        contents = [zip.read(fp) for fp in fps]
+        stage['bytes_out'] = sum(len(content) for content in contents)
+
+    with report.stage('parse', sum(len(content) for content in contents)) as stage:
+        with ProcessPoolExecutor() as pool:
+            futures = {pool.submit(parse_book_rtf, content): i for i, content in enumerate(contents)}
+            for future in as_completed(futures):
+                i = futures[future]
+                book, timings = future.result()
+                report.book(names[i], len(contents[i]), **timings)
+                stage['bytes_out'] += timings['bytes_out']
+                yield i, book
+
+def parse_book_rtf(book_rtf_bytes):
+    '''Converts and parses one book's rtf, in a pool process; the rtf conversion is the slow part.
+    Returns (book, timings) with how long each step took, for SetupReport.'''
+    start = time.perf_counter()
+    book_text = rtf_to_text(book_rtf_bytes.decode('utf-8'))
+    converted = time.perf_counter()
+    book = parse_book(book_text)
+    parsed = time.perf_counter()
+    timings = {
+        'convert_seconds': converted - start,
+        'parse_seconds': parsed - converted,
+        'bytes_out': sum(len(text.encode('utf-8')) for _, verses in iter_parsed_chapters(book) for text in verses.values()),
+    }
+    return book, timings
 
 def parse_book(book_text):
     '''Strips extraneous text from .RTF book content, namely the summary.
@@ -101,52 +312,64 @@ def parse_book(book_text):
         or Chapterless:
         {1: '..', 2: '', ..}
     '''
-
     if has_chapters(book_text):
-        # skip summary
-        lines = iter(book_text.split('\n'))
-
-        # print( text.split('\n')[0] )
-
-        # dispose summary
-        last_chapter = 0
-        while True:
-            line = next(lines)
-            match = re.search('(?:Chapter|Psalm)? ?([0-9]+)', line)
-            if match:
-                chapter_num = int( match.group(1) )
-                if chapter_num > last_chapter:
-                    last_chapter = chapter_num
-                else:
-                    lines = (line, *lines) # add this chapter 1 line back for parsing
-                    break
-
-        # print(last_chapter)
-        # print(len(lines))
-        # print(lines[:2])
-
-        # only use the important text
-        book_text = '\n'.join(lines)
         chapters = dict()
-        # nums_and_chapters = re.split(CHAPTER_PATTERN, book_text)#[1:] # skip summary
-        nums_and_chapters = re.split('(?:Chapter|Psalm) ([0-9]+)', book_text)[1:] # skip first empty string
-
-        for num, chapter in every2(nums_and_chapters):
-            # print(num)
-            # print(chapter)
-            # break
-            chapters[num] = parse_verses(chapter)
+        for chapter, verse, start, stop in iter_verse_spans(book_text):
+            chapters.setdefault(chapter, dict())[verse] = book_text[start:stop].strip()
         return chapters
     else:
-        _, chapter_text = re.split(CHAPTERLESS_PATTERN, book_text) # skip summary by splitting on gap
-        return parse_verses(chapter_text)
+        return {verse: book_text[start:stop].strip()
+                for _, verse, start, stop in iter_verse_spans(book_text)}
+
+def iter_verse_spans(book_text):
+    '''One pass over a book's text, yielding (chapter, verse, start, stop) for every verse.
+    book_text[start:stop] is the verse, still with surrounding whitespace. chapter is None if the book has none.
+
+    Text before a chapter's first verse is dropped, which is the book summary before chapter 1
+    (or before verse 1 in a chapterless book), and Psalm superscriptions.'''
+    if has_chapters(book_text):
+        headings = HEADING_PATTERN.finditer(book_text)
+        started = False     # until the first heading, numbers are part of the summary
+        pos = 0
+    else:
+        headings = iter(())
+        started = True
+        first_verse = CHAPTERLESS_PATTERN.search(book_text)
+        pos = first_verse.end() if first_verse else len(book_text)
 
-def parse_verses(chapter_text):
-    verses = dict()
-    nums_and_verses = re.split(VERSE_PATTERN, chapter_text)[1:] # empty str at beginning of split
-    for num, verse in every2(nums_and_verses):
-        verses[num] = verse.strip()
-    return verses
+    chapter = None
+    verse = None
+    heading = next(headings, None)
+    while True:
+        # verse numbers are digits before a nbsp. str.find is much quicker than a regex here
+        nbsp = book_text.find('\xa0', pos)
+        if nbsp == -1:
+            number_start = nbsp = len(book_text)
+        else:
+            number_start = nbsp
+            while number_start > pos and book_text[number_start-1] in '0123456789':
+                number_start -= 1
+            if number_start == nbsp:
+                pos = nbsp + 1
+                continue
+
+        # any chapter headings come first
+        while heading is not None and heading.start() < number_start:
+            if verse is not None:
+                yield chapter, verse, verse_start, heading.start()
+                verse = None
+            chapter = heading.group(1)
+            started = True
+            heading = next(headings, None)
+
+        if verse is not None:
+            yield chapter, verse, verse_start, number_start
+            verse = None
+        if nbsp == len(book_text):
+            return
+        if started:
+            verse, verse_start = book_text[number_start:nbsp], nbsp + 1
+        pos = nbsp + 1
 
 def has_chapters(book_text):
     return re.search(CHAPTER_PATTERN, book_text) is not None
@@ -156,21 +379,82 @@ def read_rtf_to_text(fp):
     with open(fp, 'r', encoding='utf-8') as file:
         return rtf_to_text(file.read())
 
-def save_as_json(content, fp):
-    with open(fp, 'w') as file:
-        json.dump(content, file)
+### --- timing report
+
+class SetupReport:
+    '''Wall time and bytes in and out of each setup stage, and of each book parsed,
+    for comparing changes to the pipeline run to run.
+
+    report = SetupReport()
+    with report.stage('write corpus', text_size) as stage:
+        ..
+        stage['bytes_out'] = corpus_size
+    print(report.format_table())'''
+
+    def __init__(self):
+        self.stages = []
+        self.books = []
+
+    @contextmanager
+    def stage(self, name, bytes_in=0):
+        # a stage wrapping yields also counts the time the caller spends between them
+        entry = {'stage': name, 'seconds': 0.0, 'bytes_in': bytes_in, 'bytes_out': 0}
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry['seconds'] = time.perf_counter() - start
+            self.stages.append(entry)
+
+    def book(self, name, bytes_in, convert_seconds, parse_seconds, bytes_out):
+        # times from the pool process that parsed it
+        self.books.append({'book': name, 'bytes_in': bytes_in, 'bytes_out': bytes_out,
+                           'convert_seconds': convert_seconds, 'parse_seconds': parse_seconds})
+
+    def total_seconds(self):
+        return sum(stage['seconds'] for stage in self.stages)
+
+    def to_json(self):
+        return {
+            'stages': [dict(stage, mb_per_second=_throughput(stage['bytes_in'], stage['seconds'])) for stage in self.stages],
+            'books': self.books,
+            'total_seconds': self.total_seconds(),
+        }
+
+    def format_table(self):
+        lines = ['{:<22}{:>9}{:>11}{:>11}{:>9}'.format('stage', 'seconds', 'in KB', 'out KB', 'MB/s')]
+        for stage in self.stages:
+            lines.append('{:<22}{:>9.3f}{:>11.0f}{:>11.0f}{:>9}'.format(
+                stage['stage'], stage['seconds'], stage['bytes_in'] / 1024, stage['bytes_out'] / 1024,
+                _format_throughput(stage['bytes_in'], stage['seconds'])))
+        lines.append('{:<22}{:>9.3f}'.format('total', self.total_seconds()))
+
+        if self.books:
+            lines.append('')
+            lines.append('{:<22}{:>9}{:>11}{:>11}{:>9}'.format('book', 'convert', 'parse', 'rtf KB', 'MB/s'))
+            for book in sorted(self.books, key=lambda book: -book['convert_seconds'] - book['parse_seconds']):
+                seconds = book['convert_seconds'] + book['parse_seconds']
+                lines.append('{:<22}{:>9.3f}{:>11.3f}{:>11.0f}{:>9}'.format(
+                    book['book'], book['convert_seconds'], book['parse_seconds'], book['bytes_in'] / 1024,
+                    _format_throughput(book['bytes_in'], seconds)))
+            lines.append('{:<22}{:>9.3f}{:>11.3f}'.format(
+                'sum', sum(book['convert_seconds'] for book in self.books), sum(book['parse_seconds'] for book in self.books)))
+        return '\n'.join(lines)
+
+def _throughput(num_bytes, seconds):
+    # MB/s, or None if there's nothing to measure
+    if not num_bytes or seconds <= 0:
+        return None
+    return num_bytes / seconds / 1e6
 
-def every2(alternating_list):
-    # to help iter ['1', '<text>', '2', '<text>', 3', ...]
-    it = iter(alternating_list)
-    for first in it:
-        second = next(it)
-        yield (first, second)
+def _format_throughput(num_bytes, seconds):
+    throughput = _throughput(num_bytes, seconds)
+    return '-' if throughput is None else '{:.1f}'.format(throughput)
 
 # # to generate chapter_counts.csv:
 # def output_chapter_counts():
 #     counts = dict()
-#     for book in constants.BOOK_NAMES:
+#     for book in shared.BOOK_NAMES:
 #         book_text = get_book_text(book)
 #         counts[book] = len(parse_raw_book(book_text)) if has_chapters(book_text) else 1
 #
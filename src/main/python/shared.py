@@ -2,6 +2,8 @@
 
 from fbs_runtime import _frozen, _source
 
+from metadata import load_metadata
+
 from pathlib import Path
 import sys
 
@@ -17,7 +19,14 @@ RESOURCE_DIR = Path(sys.executable).parent if IS_FROZEN else _source.project_dir
 BUILD_SETTINGS = _frozen.BUILD_SETTINGS if IS_FROZEN else _source.load_build_settings(_source.project_dir)# json.load(Path.cwd() / 'src/build/settings/base.json')
 
 BOOK_DIR = RESOURCE_DIR / 'data/cleaned'
-BOOK_FP_TEMPLATE = str(BOOK_DIR / '{}.json')
+BIBLE_ZIP_FP = BOOK_DIR / 'nwt_E.rtf.zip'   # downloaded source, kept so a broken download can resume
+MANIFEST_FP = BOOK_DIR / 'manifest.json'   # crc and size of each book in the zip at the last setup
+CORPUS_FP = BOOK_DIR / 'bible.bin'   # packed text of every book; see corpus.py
+METADATA_FP = BOOK_DIR / 'metadata.json'    # book, chapter and verse counts of the corpus; see metadata.py
+BOOK_CACHE_SIZE = 8     # decoded books kept in memory at once
+SEARCH_DB_FP = BOOK_DIR / 'search.db'   # full text index of verses; see search.py
+TRIGRAM_FP = BOOK_DIR / 'trigrams.bin'  # narrows regex searches; see trigrams.py
+REGEX_TIME_LIMIT = 2.0  # seconds a regex search may spend on a chunk of verses; settings.ini can override
 
 ###--- other app-specific constants
 
@@ -29,11 +38,17 @@ def _read_csv(fp):
             yield line.split(',')
             line = file.readline()
 
-CHAPTER_COUNTS = {
-    book_name: int(count)
-    for book_name, count in _read_csv(RESOURCE_DIR / 'data/chapter_counts.csv')
-    # for book_name, count in _read_csv('../resources/data/chapter_counts.csv')
-}
+def read_chapter_counts():
+    # the hand-written table, in canonical book order. setup names books by it
+    return {
+        book_name: int(count)
+        for book_name, count in _read_csv(RESOURCE_DIR / 'data/chapter_counts.csv')
+        # for book_name, count in _read_csv('../resources/data/chapter_counts.csv')
+    }
+
+METADATA = load_metadata(METADATA_FP)   # None until setup has run
+
+CHAPTER_COUNTS = METADATA.chapter_counts if METADATA is not None else read_chapter_counts()
 # CHAPTER_COUNTS = {'Zephaniah': 3, 'Haggai': 2, 'Zechariah': 14, 'Malachi': 4, 'Matthew': 28, 'Mark': 16, 'Luke': 24, 'John': 21, 'Acts': 28, 'Romans': 16, '1 Corinthians': 16, '2 Corinthians': 13, 'Galatians': 6, 'Ephesians': 6, 'Philippians': 4, 'Colossians': 4, '1 Thessalonians': 5, '2 Thessalonians': 3, '1 Timothy': 6, '2 Timothy': 4, 'Titus': 3, 'Philemon': 1, 'Hebrews': 13, 'James': 5, '1 Peter': 5, '2 Peter': 3, '1 John': 5, '2 John': 1, '3 John': 1, 'Jude': 1, 'Revelation': 22}
 BOOK_NAMES = list(CHAPTER_COUNTS.keys())
 
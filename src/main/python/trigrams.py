@@ -0,0 +1,293 @@
+'''Trigram index over verse text, to narrow regex searches before running the regex.
+
+Every verse's lowercased text is split into overlapping 3 char trigrams,
+each with a posting list of the rows containing it. A regex is planned into
+an AND/OR query of trigrams its matches must contain; only rows satisfying
+that query need the real regex.
+
+Layout of the cached file, little endian:
+    header    magic, format version, posting typecode, verse count, trigram count, posting count
+    keys      sorted u64 trigram keys, see _key()
+    starts    u32 index into postings where each key's list begins, then the end
+    postings  rows, ascending within each list'''
+
+from array import array
+from bisect import bisect_left
+import os
+import struct
+import sys
+
+try:
+    import re._parser as sre_parse     # python 3.11+
+    from re import _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+MAGIC = b'FBTG'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sHcxIII')
+
+def _key(trigram):
+    # 3 code points packed in one sortable int
+    a, b, c = (ord(ch) for ch in trigram)
+    return a << 42 | b << 21 | c
+
+def iter_trigrams(s):
+    return (s[i:i+3] for i in range(len(s) - 2))
+
+### --- building and loading
+
+def build_trigram_index(fp, corpus):
+    '''Indexes every verse in corpus and writes the index to fp.'''
+    postings = _index_rows(corpus, [range(corpus.num_verses)])
+    _write(fp, corpus.num_verses, ((key, [postings[key]]) for key in sorted(postings)))
+
+def update_trigram_index(fp, corpus, kept):
+    '''Rewrites the index at fp for a rewritten corpus, reusing the postings of rows whose text didn't change.
+
+    kept: [(rows, old_start)], each a range of rows in corpus with the same text as
+    the rows starting at old_start in the corpus fp was built from.
+    Every other row is indexed afresh. Builds from scratch if the old index can't be used.'''
+    try:
+        old = TrigramIndex(fp)
+    except (OSError, ValueError):
+        old = None
+    typecode = _typecode(corpus.num_verses)
+    if old is None or old.postings.typecode != typecode:
+        build_trigram_index(fp, corpus)
+        return
+
+    # new rows in order, as runs copied from the old index (old_start) or indexed afresh (None)
+    segments = []
+    row = 0
+    for rows, old_start in _merge_runs(kept):
+        if row < rows.start:
+            segments.append((range(row, rows.start), None))
+        segments.append((rows, old_start))
+        row = rows.stop
+    if row < corpus.num_verses:
+        segments.append((range(row, corpus.num_verses), None))
+
+    fresh = _index_rows(corpus, [rows for rows, old_start in segments if old_start is None])
+    old_indexes = {key: i for i, key in enumerate(old.keys)}
+
+    def pieces(key):
+        i = old_indexes.get(key)
+        old_rows = old.postings[old.starts[i] : old.starts[i+1]] if i is not None else old.postings[0:0]
+        new_rows = fresh.get(key, old_rows[0:0])
+        result = []
+        for rows, old_start in segments:
+            if old_start is None:
+                lo, hi = bisect_left(new_rows, rows.start), bisect_left(new_rows, rows.stop)
+                result.append(new_rows[lo:hi])
+            else:
+                lo, hi = bisect_left(old_rows, old_start), bisect_left(old_rows, old_start + len(rows))
+                shift = rows.start - old_start
+                piece = old_rows[lo:hi]
+                result.append(array(typecode, [r + shift for r in piece]) if shift else piece)
+        return result
+
+    keys = sorted(set(old_indexes) | set(fresh))
+    _write(fp, corpus.num_verses, ((key, pieces(key)) for key in keys))
+
+def _merge_runs(kept):
+    # joins runs that continue each other in both corpora
+    merged = []
+    for rows, old_start in sorted(kept, key=lambda run: run[0].start):
+        if merged:
+            prev_rows, prev_old_start = merged[-1]
+            if prev_rows.stop == rows.start and prev_old_start + len(prev_rows) == old_start:
+                merged[-1] = (range(prev_rows.start, rows.stop), prev_old_start)
+                continue
+        merged.append((rows, old_start))
+    return merged
+
+def _index_rows(corpus, ranges):
+    # {key: array of rows} for every trigram in the given ranges of rows
+    postings = {}
+    typecode = _typecode(corpus.num_verses)
+    for rows in ranges:
+        for row, text in zip(rows, corpus.texts(rows)):
+            for trigram in set(iter_trigrams(text.lower())):
+                rows_with = postings.get(trigram)
+                if rows_with is None:
+                    rows_with = postings[trigram] = array(typecode)
+                rows_with.append(row)
+    return {_key(trigram): rows_with for trigram, rows_with in postings.items()}
+
+def _typecode(num_verses):
+    return 'H' if num_verses <= 0xFFFF else 'I'
+
+def _write(fp, num_verses, items):
+    # items: (key, [arrays of rows]) in key order. keys left with no rows are dropped
+    typecode = _typecode(num_verses)
+    keys = array('Q')
+    starts = array('I', [0])
+    flat = array(typecode)
+    for key, pieces in items:
+        for piece in pieces:
+            flat.extend(piece)
+        if len(flat) > starts[-1]:
+            keys.append(key)
+            starts.append(len(flat))
+
+    if sys.byteorder == 'big':
+        for arr in (keys, starts, flat):
+            arr.byteswap()
+
+    tmp_fp = str(fp) + '.tmp'
+    with open(tmp_fp, 'wb') as file:
+        file.write(_HEADER.pack(MAGIC, VERSION, typecode.encode(), num_verses, len(keys), len(flat)))
+        keys.tofile(file)
+        starts.tofile(file)
+        flat.tofile(file)
+    os.replace(tmp_fp, str(fp))
+
+def open_trigram_index(fp, corpus):
+    '''Loads the cached index, first building it if it's missing or stale.'''
+    try:
+        index = TrigramIndex(fp)
+        if index.num_verses == corpus.num_verses:
+            return index
+    except (OSError, ValueError):
+        pass
+    build_trigram_index(fp, corpus)
+    return TrigramIndex(fp)
+
+class TrigramIndex:
+    '''Posting lists loaded from a file written by build_trigram_index().
+
+    index.candidates('Jehovah.*(shepherd|king)')
+    >>> [row, row, ..]   # superset of rows that can match, ascending
+    index.candidates('.*')
+    >>> None     # can't narrow; check everything'''
+
+    def __init__(self, fp):
+        with open(fp, 'rb') as file:
+            header = file.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                raise ValueError('unrecognized trigram index: {}'.format(fp))
+            magic, version, typecode, self.num_verses, num_keys, num_postings = _HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('unrecognized trigram index: {}'.format(fp))
+
+            self.keys = array('Q')
+            self.starts = array('I')
+            self.postings = array(typecode.decode())
+            self.keys.fromfile(file, num_keys)
+            self.starts.fromfile(file, num_keys+1)
+            self.postings.fromfile(file, num_postings)
+
+        if sys.byteorder == 'big':
+            for arr in (self.keys, self.starts, self.postings):
+                arr.byteswap()
+
+    def rows_with(self, trigram):
+        i = bisect_left(self.keys, _key(trigram))
+        if i == len(self.keys) or self.keys[i] != _key(trigram):
+            return self.postings[0:0]
+        return self.postings[self.starts[i] : self.starts[i+1]]
+
+    def candidates(self, pattern):
+        # ascending rows that might match pattern, or None if the pattern can't be narrowed
+        return self.query(plan_regex(pattern))
+
+    def query(self, query):
+        # same, for an already planned query
+        if query is ANY:
+            return None
+        return sorted(self._evaluate(query))
+
+    def _evaluate(self, query):
+        op, args = query
+        if op == 'trigram':
+            return set(self.rows_with(args))
+        if op == 'and':
+            # start from the rarest, then only check survivors against the rest
+            ordered = sorted(args, key=self._cost)
+            result = self._evaluate(ordered[0])
+            for sub in ordered[1:]:
+                if not result:
+                    break
+                if sub[0] == 'trigram':
+                    postings = self.rows_with(sub[1])
+                    result = {row for row in result if _contains(postings, row)}
+                else:
+                    result &= self._evaluate(sub)
+            return result
+        # 'or'
+        result = set()
+        for sub in args:
+            result |= self._evaluate(sub)
+        return result
+
+    def _cost(self, query):
+        # posting list size for a trigram; nested queries go after
+        op, args = query
+        return len(self.rows_with(args)) if op == 'trigram' else self.num_verses + len(args)
+
+def _contains(sorted_rows, row):
+    i = bisect_left(sorted_rows, row)
+    return i < len(sorted_rows) and sorted_rows[i] == row
+
+### --- planning a trigram query from a regex
+
+# queries are nested tuples:
+#   ('trigram', 'abc'), ('and', [queries]), ('or', [queries]), or ANY for no constraint
+ANY = ('any', None)
+
+def plan_regex(pattern):
+    '''Trigram query every match of pattern must satisfy, or ANY.
+    Conservative: literal runs shorter than 3 chars and anything not understood add no constraint.
+
+    plan_regex('in the')
+    >>> ('and', [('trigram', 'in '), ('trigram', 'n t'), ('trigram', ' th'), ('trigram', 'the')])'''
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (sre_constants.error, RecursionError):
+        return ANY
+    return _plan_sequence(parsed)
+
+def plan_literal(s):
+    # every trigram of s, lowercased like the index. ANY if s is too short
+    return plan_all([('trigram', t) for t in set(iter_trigrams(s.lower()))])
+
+def _plan_sequence(items):
+    parts = []
+    run = []    # consecutive literal chars, lowercased like the index
+
+    def flush():
+        parts.append(plan_literal(''.join(run)))
+        run.clear()
+
+    for op, arg in items:
+        if op is sre_constants.LITERAL:
+            run.append(chr(arg).lower())
+            continue
+        flush()
+        if op is sre_constants.SUBPATTERN:
+            parts.append(_plan_sequence(arg[-1]))
+        elif op is sre_constants.BRANCH:
+            parts.append(plan_any([_plan_sequence(branch) for branch in arg[1]]))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT, getattr(sre_constants, 'POSSESSIVE_REPEAT', None)):
+            low, _, body = arg
+            if low >= 1:
+                parts.append(_plan_sequence(body))
+        elif op is getattr(sre_constants, 'ATOMIC_GROUP', None):
+            parts.append(_plan_sequence(arg))
+        # anything else (classes, anchors, lookarounds, backrefs, ..) constrains nothing
+    flush()
+    return plan_all(parts)
+
+def plan_all(queries):
+    queries = [q for q in queries if q is not ANY]
+    if not queries:
+        return ANY
+    return queries[0] if len(queries) == 1 else ('and', queries)
+
+def plan_any(queries):
+    if not queries or any(q is ANY for q in queries):
+        return ANY
+    return queries[0] if len(queries) == 1 else ('or', queries)
@@ -8,15 +8,32 @@ from fbs_runtime.application_context.PyQt5 import ApplicationContext
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtCore import QSettings
 
+from downloads import download, iter_range, get_json, get_json_if_changed, hash_file, DownloadError, DOWNLOAD_CHUNK_SIZE
 import requests
 
+from contextlib import contextmanager
+from itertools import chain
 from pathlib import Path
-from threading import Thread
+from threading import Thread, Event
 import subprocess
-from io import BytesIO
-from zipfile import ZipFile
+import tempfile
+import time
+from zipfile import ZipFile, BadZipFile, ZIP_STORED, ZIP_DEFLATED
+import hashlib
+import json
+import os
 import shutil
+import struct
 import sys
+import zlib
+
+LATEST_RELEASE_URL = 'https://api.github.com/repos/wong-justin/fast-bible/releases/latest'  # my repo wong-justin/fast-bible
+UPDATE_CHECK_INTERVAL = 24 * 60 * 60    # seconds between checks; settings.ini can override
+UPDATE_CHECK_TIMEOUT = 10   # seconds to wait on a response
+UPDATE_TIME_LIMIT = 10 * 60     # seconds a whole check and download may take
+UPDATE_CANCEL_WAIT = 1  # seconds quitting waits for a cancelled check to wind down
+APPLY_UPDATE_ARG = '--apply-update'     # runs the app as the update applier instead, see apply_update_main()
+APPLY_UPDATE_WAIT = 30  # seconds the applier waits for the app to close before giving up until next time
 
 class AutoUpdatingApp(QApplication):
     '''Minimum auto update functionality.
@@ -26,49 +43,29 @@ class AutoUpdatingApp(QApplication):
         - solve issue of replacing current executable by downloading files to tmp,
         then moving/replacing files after app close
         - make update effective next app session
+        - check at most once per update_check_interval, see UpdateChecker
+        - retry applying a staged update on every quit until it succeeds
     Does not:
         - notify user or give user options
         - update a session that never ends, ie check for update after initial session start
         - necessarily update an app more than one version behind latest
-        - handle possible race conditions, eg. reopening app before apply_update finishes
-        - handle errors'''
-
-    def download_update(self):
-        # new update has been confirmed, so download files from previously set url
-        updates_dir = Path('./updates')
-        updates_dir.mkdir(exist_ok=True)
-
-        with download_zip(self.download_url) as _zip:
-            unzip(_zip, updates_dir)
-
-    def check_for_update(self):
-        # if newer version exists, sets download url and returns True
-        # https://docs.github.com/en/rest/reference/repos#releases
-
-        latest_release_url = 'https://api.github.com/repos/wong-justin/fast-bible/releases/latest'  # my repo wong-justin/fast-bible
-        release_info = requests.get(latest_release_url).json()
-        latest_ver = parse_github_version_tag( release_info['tag_name'] )
-        current_ver = BUILD_SETTINGS['version']
-
-        if not version_greater_than(latest_ver, current_ver):
-            return False
-
-        # real way when partial files asset is uploaded
-        assets = release_info['assets']   # list of objs
-        updated_files_asset = find_obj_where(assets, lambda x:x['name'] == 'updated_files.zip') # must be named this during release
-        self.download_url = updated_files_asset['browser_download_url']
-        return True
+        - handle possible race conditions, eg. reopening app before apply_update finishes'''
 
     def apply_update(self):
-        # called right before sys.exit()
-        subprocess.Popen(windows_move_script, shell=True, close_fds=True)
-        # QProcess.startDetached(windows_move_script, [])   # alternative, I think it works
-
-    def download_new_release_if_available(self):
-        # called in separate thread to avoid blocking gui
-        if self.check_for_update():
-            self.download_update()
-            self.settings.setValue('updated', True)  # signal for future
+        # called right before sys.exit(). the applier waits for this process to end, then swaps files in
+        install_dir = Path.cwd()
+        command = _relaunch_command() + [APPLY_UPDATE_ARG, str(os.getpid()), str(install_dir), str(install_dir / 'updates')]
+        if sys.platform == 'win32':
+            # subprocess only names DETACHED_PROCESS from python 3.7
+            flags = getattr(subprocess, 'DETACHED_PROCESS', 0x00000008) | getattr(subprocess, 'CREATE_NEW_PROCESS_GROUP', 0x00000200)
+            detached = {'creationflags': flags}
+        else:
+            detached = {'start_new_session': True}
+        try:
+            subprocess.Popen(command, close_fds=True, cwd=str(install_dir), **detached)
+        except (OSError, AttributeError, ValueError) as e:
+            # quitting matters more; the update stays staged for next time
+            print('update not applied:', e)
 
     def run(self):
         # higher level replacelement for _exec. makes sense to handle sys exit here,
@@ -83,40 +80,149 @@ class AutoUpdatingApp(QApplication):
         super().__init__(*args, **kwargs)
         self.settings = QSettings( str(RESOURCE_DIR / 'settings.ini'), QSettings.IniFormat)  # I can specify the location
         # self.settings = QSettings('FastBible', 'FastBible')   # alternative, saved in some OS specific location
+        self.updater = UpdateChecker(RESOURCE_DIR / 'settings.ini', BUILD_SETTINGS['version'])
 
     def exec_(self):
         # check for updates, then run as normal
         if self.settings.value('updated', defaultValue=False):    # from last session
             # self.show_update_notes()  # example of when to notify user
             self.settings.setValue('updated', False)
-        Thread(target=self.download_new_release_if_available).start()     # avoid during testing
-        super().exec_()
+        self.updater.start()     # in the background, if it's time to
+        return super().exec_()
 
     def quit(self):
         # apply update if exists, then quit as normal
         print('about to quit')
-        if self.settings.value('updated', defaultValue=False):
+        self.updater.cancel()
+        self.settings.sync()    # pick up anything the updater wrote
+        # whether just downloaded or left by an apply that failed last time
+        if has_staged_update(Path.cwd() / 'updates'):
             self.apply_update()
         super().quit()
 
-# this is called after new executable is downloaded into tmp
-#  and old main executable is done running
-windows_move_script = (
-    # pause to make sure the app is finished closing
-    r'timeout /t 2 & ' + # more accurate pause: powershell -nop -c "& {sleep -m 1000}"
-    # copy new files into main dir, overwriting existing files and including new subdirs
-    r'cd updates & xcopy * ..\ /e /y & ' +
-    # r'move %~dp0\updates\* %~dp0\ '   # %~dp0 is dir containing this script
-    # r'move "%~dp0\tmp\Fast Bible.exe" "%~dp0\Fast Bible.exe"'
-
-    # cleanup: delete tmp dir
-    # r'cd ..\ & rmdir /s %cd%\updates\*'
-    # r'del * /q & echo finished update & exit'
-    r'cd ..\ & rmdir /s /q updates & echo finished update'
-    # 'echo %cd%\*'
-    # r'rmdir /s /q %cd%\* & del %cd%\* & echo done'
-    # r'rmdir /s /q/ "*" /y & del "*" /y & echo done'
-)
+class UpdateCancelled(Exception):
+    pass
+
+class UpdateChecker:
+    '''Checks the latest github release on a daemon thread, and downloads it if it's newer.
+
+    Checks at most once per update_check_interval seconds in settings.ini.
+    The release's ETag is kept after each check, so an unchanged release costs a 304.
+    Each request gives up after UPDATE_CHECK_TIMEOUT seconds without a response or data,
+    and a download is stopped at its next chunk once the whole check has taken UPDATE_TIME_LIMIT.
+    That isn't a hard limit: a single request that trickles data can still overrun it.
+    cancel() stops a check or download partway; being a daemon, it never keeps the app open either way.
+    Downloads go to updates_dir.part, renamed to updates_dir once complete, replacing any update
+    staged there before. So updates_dir only ever holds a whole release, ready for the applier.
+    Sets 'updated' in settings once a download finishes.
+
+    checker = UpdateChecker(RESOURCE_DIR / 'settings.ini', '0.1.2')
+    checker.start()
+    ..
+    checker.cancel()   # when quitting'''
+
+    def __init__(self, settings_fp, current_version, release_url=LATEST_RELEASE_URL,
+                 install_dir=Path('.'), updates_dir=Path('./updates')):
+        self.settings_fp = str(settings_fp)
+        self.current_version = current_version
+        self.release_url = release_url
+        self.install_dir = install_dir
+        self.updates_dir = updates_dir
+        self.thread = None
+        self._stop = Event()
+        self._deadline = None
+
+    def start(self):
+        # returns whether a check was started
+        if not self.is_due(self._settings()):
+            return False
+        self._stop.clear()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return True
+
+    def cancel(self, wait=UPDATE_CANCEL_WAIT):
+        # stops at the next chunk or request, waiting up to wait seconds for that
+        self._stop.set()
+        if self.thread is not None:
+            self.thread.join(wait)
+
+    def is_due(self, settings):
+        last_check = settings.value('last_update_check', 0, type=float)
+        interval = settings.value('update_check_interval', UPDATE_CHECK_INTERVAL, type=float)
+        return time.time() - last_check >= interval
+
+    def run(self):
+        # one check, and download if there's an update. runs on self.thread
+        settings = self._settings()     # own instance; QSettings objects aren't shared across threads
+        self._deadline = time.time() + UPDATE_TIME_LIMIT
+        try:
+            etag = settings.value('release_etag', '')
+            release_info, new_etag = get_json_if_changed(self.release_url, etag, timeout=UPDATE_CHECK_TIMEOUT)
+            settings.setValue('last_update_check', time.time())
+            if release_info is None:
+                return  # same release as last time, already dealt with
+            self._check_stop()
+            urls = self.newer_release_urls(release_info)
+            if urls is not None:
+                self.download_update(*urls)
+                settings.setValue('updated', True)  # signal for future
+            # only now is this release dealt with
+            settings.setValue('release_etag', new_etag or '')
+        except (UpdateCancelled, DownloadError, BadZipFile, OSError,
+                requests.RequestException, ValueError, KeyError, TypeError) as e:
+            # BadZipFile for eg an error page instead of a zip, OSError for writing ./updates
+            print('update check stopped:', e)
+        finally:
+            self._deadline = None
+            settings.sync()
+
+    def newer_release_urls(self, release_info):
+        # (zip url, manifest url or None, zip size or None) if the release is newer than this version, else None
+        # https://docs.github.com/en/rest/reference/repos#releases
+        latest_ver = parse_github_version_tag( release_info['tag_name'] )
+        if not version_greater_than(latest_ver, self.current_version):
+            return None
+
+        # real way when partial files asset is uploaded
+        assets = release_info['assets']   # list of objs
+        updated_files_asset = find_obj_where(assets, lambda x:x['name'] == 'updated_files.zip') # must be named this during release
+        # made from updated_files.zip by write_release_manifest(); older releases don't have one
+        manifest_asset = find_obj_where(assets, lambda x:x['name'] == RELEASE_MANIFEST_NAME)
+        return (updated_files_asset['browser_download_url'],
+                manifest_asset['browser_download_url'] if manifest_asset else None,
+                updated_files_asset.get('size'))
+
+    def download_update(self, download_url, manifest_url=None, size=None):
+        # new update has been confirmed, so download its files
+        part_dir = self.updates_dir.with_name(self.updates_dir.name + '.part')
+        shutil.rmtree(str(part_dir), ignore_errors=True)    # from a download that was cut off
+        part_dir.mkdir(parents=True)
+        try:
+            # only the files that differ from this install, if the release lists them
+            if manifest_url is not None:
+                manifest = get_json(manifest_url, timeout=UPDATE_CHECK_TIMEOUT)
+                download_changed_files(download_url, manifest, self.install_dir, part_dir, self._check_stop)
+            else:
+                with download_zip(download_url, self._check_stop, size) as _zip:
+                    unzip(_zip, part_dir)
+        except BaseException:
+            shutil.rmtree(str(part_dir), ignore_errors=True)
+            raise
+
+        # a whole release, differing from this install in full, so anything staged before is superseded
+        shutil.rmtree(str(self.updates_dir), ignore_errors=True)
+        os.replace(str(part_dir), str(self.updates_dir))
+
+    def _check_stop(self, *progress):
+        # as a download progress callback, aborts it when cancelled or out of time
+        if self._stop.is_set():
+            raise UpdateCancelled()
+        if self._deadline is not None and time.time() > self._deadline:
+            raise UpdateCancelled('took longer than {} seconds'.format(UPDATE_TIME_LIMIT))
+
+    def _settings(self):
+        return QSettings(self.settings_fp, QSettings.IniFormat)
 
 class MyAppContext(ApplicationContext):
     # don't use default QApplication
@@ -126,26 +232,269 @@ class MyAppContext(ApplicationContext):
 
 ### --- helpers
 
-def download_zip(url):
-    # returns ZipFile of http response from download url
-    response = requests.get(url)
-    filelike = BytesIO(response.content)
-    return ZipFile(filelike)
+@contextmanager
+def download_zip(url, progress=None, size=None, sha256=None):
+    '''ZipFile of the download at url, streamed a chunk at a time to a temp file
+    instead of memory. The file is deleted once the with block exits.
+    progress, and the size and sha256 to check it against, are passed on to download().
+
+    with download_zip(url) as _zip:
+        unzip(_zip, updates_dir)'''
+    with tempfile.TemporaryDirectory() as folder:
+        fp = Path(folder) / 'update.zip'
+        download(url, fp, progress, size, sha256)
+        with ZipFile(str(fp)) as _zip:
+            yield _zip
 
 def unzip(_zip, _dir):
-    # extract files from ZipFile
+    # extract files from ZipFile, a chunk at a time
     for info in _zip.filelist:
         outpath = _dir / strip_first_folder(info.filename)    # rid that redundant folder in zip files
-        # yield str(outpath)
 
-        # try:
         if info.is_dir():
-            outpath.mkdir(exist_ok=True)
+            outpath.mkdir(parents=True, exist_ok=True)
+        else:
+            outpath.parent.mkdir(parents=True, exist_ok=True)   # folders aren't always members of their own
+            with _zip.open(info) as source_file, open(str(outpath), 'wb') as target_file:   # overwrites
+                shutil.copyfileobj(source_file, target_file, DOWNLOAD_CHUNK_SIZE)
+
+### --- applying updates
+
+def has_staged_update(updates_dir):
+    return updates_dir.is_dir() and any(fp.is_file() for fp in updates_dir.rglob('*'))
+
+def apply_update_main(argv):
+    '''Entry point of the applier process: argv is [parent pid, install dir, updates dir].
+    Returns an exit code.'''
+    parent_pid, install_dir, updates_dir = int(argv[0]), Path(argv[1]), Path(argv[2])
+    try:
+        applied = apply_staged_update(install_dir, updates_dir, parent_pid)
+    except (OSError, TimeoutError) as e:
+        print('update not applied:', e)
+        return 1
+    print('applied update:', *applied, sep='\n')
+    return 0
+
+def apply_staged_update(install_dir, updates_dir, parent_pid=None, timeout=APPLY_UPDATE_WAIT):
+    '''Moves every file in updates_dir to the same path in install_dir, all or nothing.
+
+    Waits for parent_pid to exit first, since a running app holds its files.
+    Each file is copied in beside its target, then the targets are swapped
+    for them one rename at a time, keeping the old files aside. If anything fails,
+    renames are undone, the install is left as it was and updates_dir is kept for another try.
+    Returns the relative paths applied. Raises TimeoutError if the parent never exits.'''
+    if parent_pid is not None:
+        wait_for_exit(parent_pid, timeout)
+    _remove_leftovers(install_dir)
+
+    paths = sorted(fp.relative_to(updates_dir) for fp in updates_dir.rglob('*') if fp.is_file())
+    staged = []     # (staged fp, target fp)
+    swapped = []    # (target fp, backup fp or None if it's new)
+    try:
+        for path in paths:
+            target = install_dir / path
+            target.parent.mkdir(parents=True, exist_ok=True)
+            staged_fp = target.with_name(target.name + _STAGED_SUFFIX)
+            shutil.copy2(str(updates_dir / path), str(staged_fp))
+            staged.append((staged_fp, target))
+
+        for staged_fp, target in staged:
+            backup = None
+            if target.exists():
+                backup = target.with_name(target.name + _OLD_SUFFIX)
+                os.replace(str(target), str(backup))    # allowed even for a running exe on windows
+            swapped.append((target, backup))
+            os.replace(str(staged_fp), str(target))
+    except OSError:
+        _roll_back(staged, swapped)
+        raise
+
+    for target, backup in swapped:
+        if backup is not None:
+            _try_remove(backup)
+    shutil.rmtree(str(updates_dir), ignore_errors=True)
+    return [path.as_posix() for path in paths]
+
+_STAGED_SUFFIX = '.update-new'
+_OLD_SUFFIX = '.update-old'
+
+def _roll_back(staged, swapped):
+    for target, backup in reversed(swapped):
+        if backup is None:
+            _try_remove(target)
+        elif backup.exists():
+            if target.exists():
+                _try_remove(target)
+            os.replace(str(backup), str(target))
+    for staged_fp, _ in staged:
+        _try_remove(staged_fp)
+
+def _remove_leftovers(install_dir):
+    # from an applier that was killed partway, or old files that couldn't be deleted while running
+    for suffix in (_OLD_SUFFIX, _STAGED_SUFFIX):
+        for fp in install_dir.rglob('*' + suffix):
+            _try_remove(fp)
+
+def _try_remove(fp):
+    try:
+        os.remove(str(fp))
+    except OSError:
+        pass
+
+def wait_for_exit(pid, timeout):
+    '''Returns once process pid has ended, polling until then. Raises TimeoutError after timeout seconds.'''
+    deadline = time.monotonic() + timeout
+    while _is_running(pid):
+        if time.monotonic() > deadline:
+            raise TimeoutError('process {} still running'.format(pid))
+        time.sleep(0.05)
+
+def _is_running(pid):
+    if sys.platform == 'win32':
+        # os.kill would terminate it on windows, so ask for its exit code instead
+        import ctypes
+        PROCESS_QUERY_LIMITED_INFORMATION, STILL_ACTIVE = 0x1000, 259
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return False
+        try:
+            exit_code = ctypes.c_ulong()
+            kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+            return exit_code.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True     # someone else's process
+    return True
+
+def _relaunch_command():
+    # this app again: the frozen executable, or python running the same script
+    if getattr(sys, 'frozen', False):
+        return [sys.executable]
+    return [sys.executable, str(Path(sys.argv[0]).resolve())]
+
+### --- delta updates
+
+# a release uploads this beside updated_files.zip, listing every file in the zip:
+#   {"files": {"relative/path": {"sha256", "size", "compress_type", "compress_size", "offset", "length"}}}
+#  offset and length are the member's bytes within the zip, local header included,
+#  so a changed file can be fetched alone with a range request
+RELEASE_MANIFEST_NAME = 'manifest.json'
+_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')   # same as zipfile's structFileHeader
+
+def write_release_manifest(zip_fp, manifest_fp):
+    '''Lists every file in a release zip with its hash and where it sits in the zip.
+    Run when publishing, then upload manifest_fp as an asset named RELEASE_MANIFEST_NAME.'''
+    files = {}
+    with ZipFile(str(zip_fp)) as _zip:
+        members = sorted(_zip.filelist, key=lambda info: info.header_offset)
+        # a member runs up to the next one, or to the central directory after the last
+        ends = [info.header_offset for info in members[1:]] + [_zip.start_dir]
+        for info, end in zip(members, ends):
+            if info.is_dir():
+                continue
+            with _zip.open(info) as file:
+                sha256, size = hash_file(file)
+            files[strip_first_folder(info.filename).as_posix()] = {
+                'sha256': sha256,
+                'size': size,
+                'compress_type': info.compress_type,
+                'compress_size': info.compress_size,
+                'offset': info.header_offset,
+                'length': end - info.header_offset,
+            }
+    with open(str(manifest_fp), 'w') as file:
+        json.dump({'files': files}, file, indent=1)
+
+def changed_files(manifest, install_dir):
+    # paths in the release manifest that are missing or different in install_dir
+    changed = []
+    for path, entry in manifest['files'].items():
+        fp = install_dir / path
+        if not fp.is_file() or fp.stat().st_size != entry['size']:
+            changed.append(path)
+            continue
+        with open(str(fp), 'rb') as file:
+            if hash_file(file)[0] != entry['sha256']:
+                changed.append(path)
+    return changed
+
+def download_changed_files(zip_url, manifest, install_dir, updates_dir, before_each=None):
+    '''Fetches just the files that changed from the release zip at zip_url, one range request each,
+    into updates_dir at their paths, a chunk at a time. Returns those paths.
+    before_each: called before each request, which can raise to stop.'''
+    changed = changed_files(manifest, install_dir)
+    for path in changed:
+        if before_each:
+            before_each()
+        outpath = updates_dir / path
+        outpath.parent.mkdir(parents=True, exist_ok=True)
+        with open(str(outpath), 'wb') as file:
+            fetch_zip_member(zip_url, manifest['files'][path], file)
+    return changed
+
+def fetch_zip_member(zip_url, entry, file):
+    '''Streams one member's content into file, from a manifest entry, inflating and hashing it
+    a chunk at a time. Raises ValueError if it doesn't check out, leaving file partly written.'''
+    start = entry['offset']
+    chunks = iter_range(zip_url, start, start + entry['length'])
+    try:
+        head = _read_at_least(chunks, b'', _LOCAL_HEADER.size)
+        fields = _LOCAL_HEADER.unpack_from(head)
+        if fields[0] != b'PK\x03\x04':
+            raise ValueError('not a zip member at offset {}'.format(start))
+        name_length, extra_length = fields[10], fields[11]
+        data_start = _LOCAL_HEADER.size + name_length + extra_length
+        head = _read_at_least(chunks, head, data_start)
+
+        if entry['compress_type'] == ZIP_STORED:
+            decompressor = None
+        elif entry['compress_type'] == ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
         else:
-            source_file = _zip.open(info.filename)
-            target_file = open(outpath, 'wb')   # overwrites
-            shutil.copyfileobj(source_file, target_file)
-    # yield 'finished'
+            raise ValueError('unsupported compression: {}'.format(entry['compress_type']))
+
+        sha256 = hashlib.sha256()
+        remaining = entry['compress_size']
+        for chunk in chain([head[data_start:]], chunks):
+            chunk = chunk[:remaining]
+            remaining -= len(chunk)
+            for content in (_inflate(decompressor, chunk) if decompressor else [chunk]):
+                sha256.update(content)
+                file.write(content)
+            if not remaining:
+                break
+        if decompressor:
+            content = decompressor.flush()
+            sha256.update(content)
+            file.write(content)
+    finally:
+        chunks.close()  # lets go of the connection
+
+    if remaining:
+        raise ValueError('truncated zip member')
+    if sha256.hexdigest() != entry['sha256']:
+        raise ValueError('checksum mismatch')
+
+def _read_at_least(chunks, head, n):
+    # head extended from chunks until it's at least n bytes
+    while len(head) < n:
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError('truncated zip member')
+        head += chunk
+    return head
+
+def _inflate(decompressor, chunk):
+    # output of chunk at most DOWNLOAD_CHUNK_SIZE at a time, however well it was compressed
+    yield decompressor.decompress(chunk, DOWNLOAD_CHUNK_SIZE)
+    while decompressor.unconsumed_tail:
+        yield decompressor.decompress(decompressor.unconsumed_tail, DOWNLOAD_CHUNK_SIZE)
 
 def strip_first_folder(path):
     p = Path(path)
@@ -2,8 +2,10 @@
 
 from book_logic import *
 from shared import *
+from search import SearchEngine, SearchTooExpensive, RegexProcess, open_search_db
+from trigrams import open_trigram_index
 
-from PyQt5.QtCore import Qt, QSize, QRect, QSettings
+from PyQt5.QtCore import Qt, QSize, QRect, QSettings, QObject, pyqtSignal, QAbstractListModel, QModelIndex
 from PyQt5.QtGui import QPalette, QColor, QFont, QFontDatabase, QIcon, QFontMetrics
 from PyQt5.QtWidgets import (QApplication, QWidget, QStackedWidget, QPushButton,
     QLineEdit, QTextEdit, QLabel, QListWidget, QHBoxLayout, QVBoxLayout, QGridLayout,
@@ -11,6 +13,9 @@ from PyQt5.QtWidgets import (QApplication, QWidget, QStackedWidget, QPushButton,
     QListWidgetItem, QStyledItemDelegate, QStyle, QListView)
 
 from types import SimpleNamespace
+from threading import Thread, Condition, Event
+from array import array
+import re
 # import ctypes
 
 class Scripture:
@@ -60,12 +65,67 @@ class Scripture:
 
 data = SimpleNamespace(
     bible=None,
+    search=None,
     curr_scripture=Scripture(),
+    loader=None,    # DataLoader, if data is being loaded in the background
 )
 
 def init_data():
-    data.bible = load_bible_json()
-    data._all_verses = list(_iter_verses_in_whole_bible())  # maybe this will be faster?
+    data.bible = load_bible()
+    settings = QSettings(str(RESOURCE_DIR / 'settings.ini'), QSettings.IniFormat)
+    time_limit = settings.value('regex_time_limit', REGEX_TIME_LIMIT, type=float)
+    data.search = SearchEngine(data.bible,
+                               open_search_db(SEARCH_DB_FP),
+                               open_trigram_index(TRIGRAM_FP, data.bible.corpus),
+                               RegexProcess(CORPUS_FP, time_limit))
+
+class DataLoader(QObject):
+    '''Runs init_data() on a background thread, so the window can show before the corpus is opened.
+
+    Pages that only need BOOK_NAMES and chapter counts from shared work right away.
+    Anything reading data.bible or data.search waits for ready, through when_loaded().
+
+    data.loader = DataLoader()
+    data.loader.start()
+    data.loader.when_loaded(lambda: print(data.bible.corpus.num_verses))'''
+
+    ready = pyqtSignal()
+    failed = pyqtSignal(str)
+
+    def __init__(self):
+        super().__init__()
+        self.loaded = Event()
+        self._waiting = None
+        # connected from the gui thread, so the waiting callback runs there too
+        self.ready.connect(self._on_ready)
+
+    def start(self):
+        Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        try:
+            init_data()
+        except Exception as e:
+            self.failed.emit(str(e))
+            raise
+        self.loaded.set()
+        self.ready.emit()
+
+    def when_loaded(self, callback):
+        # calls callback now if loaded, else once it is. only the newest waiting callback is kept
+        if self.loaded.is_set():
+            self._waiting = None
+            callback()
+        else:
+            self._waiting = callback
+
+    def cancel_waiting(self):
+        self._waiting = None
+
+    def _on_ready(self):
+        callback, self._waiting = self._waiting, None
+        if callback is not None:
+            callback()
 
 ### --- widgets to implement
 
@@ -140,6 +200,9 @@ class PageManager(QStackedWidget):
 
         self._history.append(self._curr_id)
 
+        if data.loader is not None:
+            data.loader.cancel_waiting()
+
         new_page = self._pages[new_id]
         if state is not None:
             new_page.load_state(state)
@@ -148,11 +211,27 @@ class PageManager(QStackedWidget):
 
     def back(self):
         '''Go to previous page. Used in default Page keyPressEvent listener.'''
+        if data.loader is not None:
+            data.loader.cancel_waiting()
+
         if self._history:
             prev_id = self._history.pop()
             prev_page = self._pages[prev_id]
             self._set_curr_page(prev_id, prev_page)
 
+    def when_loaded(self, callback):
+        '''Runs callback once data is loaded, right away if it already is.
+        For navigating to a page that needs verses, while they may still be loading in the background.
+        Navigating anywhere in the meantime drops it.
+
+        self.nav.when_loaded(lambda: self.nav.to(VersesPage, state=scripture_rows(scripture)))'''
+        if data.loader is None:
+            callback()  # loaded up front by init_data()
+            return
+        if not data.loader.loaded.is_set():
+            self.set_title('loading...')
+        data.loader.when_loaded(callback)
+
     def _set_curr_page(self, _id, page):
         self._curr_id = _id
         self.curr_page = page
@@ -307,6 +386,117 @@ class FilterableList(QListWidget, Filterable):
 
         Filterable.keyPressEvent(self, event)
 
+class SearchWorker(QObject):
+    '''Runs searches on a background thread so typing never waits on a scan.
+
+    Each request() starts a new generation. A search still running for an older
+    generation stops at its next chunk, and nothing more is emitted for it.
+
+    worker.found.connect(lambda generation, rows: ..)       # matches, a chunk at a time
+    worker.finished.connect(lambda generation, error: ..)   # error is '' or a message for the user
+    generation = worker.request('love', rows)'''
+
+    found = pyqtSignal(int, list)
+    finished = pyqtSignal(int, str)
+
+    def __init__(self):
+        super().__init__()
+        self.generation = 0
+        self._request = None
+        self._wakeup = Condition()
+        Thread(target=self._run, daemon=True).start()
+
+    def request(self, search_text, rows):
+        with self._wakeup:
+            self.generation += 1
+            self._request = (self.generation, search_text, rows)
+            self._wakeup.notify()
+        return self.generation
+
+    def cancel(self):
+        # stop whatever is running without starting anything new
+        with self._wakeup:
+            self.generation += 1
+            self._request = None
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                while self._request is None:
+                    self._wakeup.wait()
+                request = self._request
+                self._request = None
+            self._search(*request)
+
+    def _search(self, generation, search_text, rows):
+        try:
+            for chunk in data.search.iter_search(search_text, rows):
+                if generation != self.generation:
+                    return  # stale; a newer search is waiting
+                if chunk:
+                    self.found.emit(generation, chunk)
+        except re.error:
+            self.finished.emit(generation, 'invalid regex')
+            return
+        except SearchTooExpensive:
+            self.finished.emit(generation, 'pattern too expensive')
+            return
+        except Exception as e:
+            # eg a broken search db; report it and stay alive for the next search
+            self.finished.emit(generation, 'search failed: {}'.format(e))
+            return
+        self.finished.emit(generation, '')
+
+class SearchResultsModel(QAbstractListModel):
+    '''List model of search matches, holding nothing but their corpus rows.
+
+    Item data for the delegate is built only when the view asks for it,
+    and matches are revealed to the view a batch at a time as it scrolls (fetchMore).'''
+
+    BATCH_SIZE = 200
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.matches = array('I')
+        self.fetched = 0    # rows the view knows about so far
+
+    def clear(self):
+        self.beginResetModel()
+        self.matches = array('I')
+        self.fetched = 0
+        self.endResetModel()
+
+    def extend(self, rows):
+        self.matches.extend(rows)
+        # first screenful shows right away; the rest waits for scrolling
+        if self.fetched < self.BATCH_SIZE:
+            self.fetchMore(QModelIndex())
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.fetched
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        row = self.matches[index.row()]
+        return {
+            'scripture': scripture_of_row(row),
+            'text': data.bible.text(row).replace('\n', ' '),
+        }
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self.fetched < len(self.matches)
+
+    def fetchMore(self, parent):
+        if parent.isValid():
+            return
+        n = min(self.BATCH_SIZE, len(self.matches) - self.fetched)
+        if n <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self.fetched, self.fetched + n - 1)
+        self.fetched += n
+        self.endInsertRows()
+
 ### --- some convenience widgets
 
 def EmptyPlaceholderWidget(parent=None, msg='placeholder'):
@@ -419,50 +609,56 @@ def keypress_produces_symbol(key):
 ### --- iterating verses depending on scripture location scope
 
 def iter_verses_in_whole_bible():
-    yield from data._all_verses
-
-def _iter_verses_in_whole_bible():
-    for book_name in BOOK_NAMES:
-        book_scripture = Scripture(book_name)
-
-        if has_chapters(book_name):
-            yield from iter_verses_in_book(book_scripture)
-        else:
-            verses = data.bible[book_name]
-            scriptures_with_verses(book_scripture, verses)
+    # read in order straight from the corpus instead of building every book's dicts
+    yield from iter_verses_in_rows(range(data.bible.corpus.num_verses))
 
 def iter_verses_in_book(book_scripture):
-    # for book with chapters
-
-    # book = data.bible[scripture.parts[0]]
-    book = get_bible_content(book_scripture)
-    for chapter_num, verses in book.items():
-        # chapter_scripture = book_scripture.inc(chapter_num)
-        yield from scriptures_with_verses(book_scripture.inc(chapter_num), verses)
+    yield from iter_verses_in_rows(scripture_rows(book_scripture))
 
 def iter_verses_in_chapter(chapter_scripture):
-    verses = get_bible_content(chapter_scripture)
-    yield from scriptures_with_verses(chapter_scripture, verses)
+    yield from iter_verses_in_rows(scripture_rows(chapter_scripture))
 
-def scriptures_with_verses(scripture, verses):
-    # chapter scripture, or possibly book scripture if book doesn't have chapters
+def iter_verses_in_rows(rows):
     yield from (
-        (scripture.inc(verse_num), text)
-        for verse_num, text in verses.items()
+        (scripture_of_row(row), text)
+        for row, text in data.bible.iter_verses(rows)
     )
 
-# def verses_around_scripture(scripture):
-#     return get_bible_content(scripture.dec())
-#
-# def get_verse(scripture):
-#     return get_bible_content(scripture)
-
-def get_bible_content(scripture):
-    # returns content at finest scope of scripture
-    scope = data.bible
-    for component in scripture.parts:
-        scope = scope[component]
-    return scope
+def iter_numbered_verses(rows):
+    # (verse_num, text) for rows within a chapter
+    corpus = data.bible.corpus
+    yield from ((corpus.verse_num(row), data.bible.text(row)) for row in rows)
+
+def scripture_rows(scripture):
+    # contiguous corpus rows covering everything in scope of scripture
+    corpus = data.bible.corpus
+    parts = scripture.parts
+    if not parts:
+        return range(corpus.num_verses)
+
+    book_name = parts[0]
+    book = BOOK_INDEXES[book_name]
+    if len(parts) == 1:
+        return corpus.book_rows(book)
+
+    # chapterless books go straight from book to verse
+    if has_chapters(book_name):
+        chapter, verse = int(parts[1]), (int(parts[2]) if len(parts) == 3 else None)
+    else:
+        chapter, verse = 1, int(parts[1])
+
+    if verse is None:
+        return corpus.chapter_rows(book, chapter)
+    row = corpus.find_row(book, chapter, verse)
+    return range(0) if row is None else range(row, row+1)
+
+def scripture_of_row(row):
+    book, chapter, verse = data.bible.corpus.location(row)
+    book_name = BOOK_NAMES[book]
+    if has_chapters(book_name):
+        return Scripture(book_name, str(chapter), str(verse))
+    else:
+        return Scripture(book_name, str(verse))
 
 ### --- boring python utils
 
@@ -488,9 +684,10 @@ def starts_with(s):
 
 def format_to_html(verses):
     # returns numbers spaced and bolded preceding verse content.
+    #  verses: iter of (num, text)
     return '   '.join(          # 2 nbsps post-num and 4 spaces pre-num looks good, even
         f'<b>{num}</b>\xa0\xa0{verse}'     # spacing probably changes with diff fonts
-        for num, verse in verses.items()
+        for num, verse in verses
     )
 
 def to_plaintext(html):
@@ -1,5 +1,5 @@
 
-from PyQt5.QtCore import Qt, QSize, QSettings, QCoreApplication, QProcess, pyqtSignal, pyqtSlot
+from PyQt5.QtCore import Qt, QSize, QSettings, QCoreApplication, QProcess, pyqtSignal, pyqtSlot, QModelIndex
 from PyQt5.QtGui import QPalette, QColor, QFont, QFontDatabase, QIcon
 from PyQt5.QtWidgets import (QApplication, QWidget, QStackedWidget, QPushButton,
     QLineEdit, QTextEdit, QLabel, QListWidget, QHBoxLayout, QVBoxLayout, QGridLayout,
@@ -161,10 +161,72 @@ def test_alternate_search_results():
     show_alternate_classes(SearchResultsPage=SearchResultsB)
 
 def test_search_results_threaded():
-    pass
+    # newer requests make older searches stale; only the newest one reports back
+    import utils
+
+    app = QApplication([])
+    init_data()
+    whole_bible = range(utils.data.bible.corpus.num_verses)
+
+    heard = []
+    worker = SearchWorker()
+    worker.found.connect(lambda generation, rows: heard.append(generation))
+    worker.finished.connect(lambda generation, error: app.quit() if generation == newest else None)
+
+    worker.request('a', whole_bible)
+    worker.request('e', whole_bible)
+    newest = worker.request('love', whole_bible)
+    app.exec_()
+
+    assert heard and set(heard) <= {1, 2, newest}
+    assert heard[-1] == newest
+
+    # an unexpected error is reported, and the worker keeps serving searches
+    from unittest.mock import patch
+    import sqlite3
+    errors = []
+    def on_finished(generation, error):
+        errors.append(error)
+        if generation == newest:
+            app.quit()
+    worker.finished.disconnect()    # one slot, so the error is recorded before quitting
+    worker.finished.connect(on_finished)
+    with patch.object(utils.data.search, 'iter_search', side_effect=sqlite3.Error('disk I/O error')):
+        newest = worker.request('love', whole_bible)
+        app.exec_()
+    assert errors[-1] == 'search failed: disk I/O error'
+    newest = worker.request('love', whole_bible)
+    app.exec_()
+    assert errors[-1] == ''
 
 def test_search_results_postpone_items_add():
-    pass
+    # model holds every match but only shows the view a batch at a time
+    app = QApplication([])
+    init_data()
+
+    model = SearchResultsModel()
+    model.extend(range(30000))
+    assert len(model.matches) == 30000
+    assert model.rowCount() == SearchResultsModel.BATCH_SIZE
+
+    while model.canFetchMore(QModelIndex()):
+        model.fetchMore(QModelIndex())
+    assert model.rowCount() == 30000
+    assert str(model.index(0).data(Qt.DisplayRole)['scripture']) == 'Genesis 1:1'
+
+def test_search_results_long_list():
+    def f():
+        init_data()
+        w = QListView()
+        model = SearchResultsModel(w)
+        model.extend(range(30000))
+        w.setModel(model)
+        w.setUniformItemSizes(True)
+        import main
+        w.setItemDelegate(main.SearchResultDelegate(w))
+        return w
+
+    show_widget(f)
 
 def test_iter_performance():
     import utils
@@ -172,12 +234,13 @@ def test_iter_performance():
     init_data()
 
     def a():
-        for v in utils._iter_verses_in_whole_bible():
+        for v in utils.iter_verses_in_whole_bible():
             pass
 
     def b():
-        for v in utils.data._all_verses:
-            pass
+        # old way, building every book's dicts
+        for book_name in BOOK_NAMES:
+            utils.data.bible[book_name]
     a()
     def c():
         pass
@@ -187,6 +250,878 @@ def test_iter_performance():
     print(_a, _b)
 
 
+def test_deferred_loading():
+    # first page works before verses load; navigating to verses waits for them
+    import utils
+    import main
+    from PyQt5.QtWidgets import QListWidgetItem
+
+    app = QApplication([])
+    utils.data.bible = utils.data.search = None
+    utils.data.loader = DataLoader()
+    try:
+        nav = PageManager(main.BooksPage, main.ChaptersPage, main.VersesPage, main.SearchResultsPage)
+        window = MarginParent(nav)
+        books, chapters = nav.curr_page, nav._pages[main.ChaptersPage]
+
+        books.on_book_selected(QListWidgetItem('Genesis'))
+        assert nav.curr_page is chapters and chapters.all_items[-1] == '50'
+
+        # waits, then is dropped by navigating away
+        chapters.on_chapter_selected(QListWidgetItem('1'))
+        assert nav.curr_page is chapters and window.windowTitle() == 'loading...'
+        nav.back()
+        utils.data.curr_scripture.dec(inplace=True)
+        books.on_book_selected(QListWidgetItem('Genesis'))
+
+        chapters.on_chapter_selected(QListWidgetItem('3'))
+        assert nav.curr_page is chapters and utils.data.bible is None
+        utils.data.loader.ready.connect(app.quit)
+        utils.data.loader.start()
+        app.exec_()
+
+        assert nav.curr_page is nav._pages[main.VersesPage]
+        assert window.windowTitle() == 'Genesis 3'
+        assert nav.curr_page.rows == scripture_rows(Scripture('Genesis', '3'))
+
+        # once loaded, navigation is immediate
+        nav.back()
+        utils.data.curr_scripture.dec(inplace=True)
+        chapters.on_chapter_selected(QListWidgetItem('4'))
+        assert window.windowTitle() == 'Genesis 4'
+    finally:
+        utils.data.loader = None
+        utils.data.curr_scripture = Scripture()
+
+def test_book_cache():
+    from book_logic import load_bible
+
+    bible = load_bible(cache_size=2)
+    genesis, exodus, leviticus = (bible.corpus.book_rows(i).start for i in range(3))
+    bible.text(genesis)
+    bible.text(genesis + 1)
+    bible.text(exodus)
+    bible.text(leviticus)   # evicts Genesis
+    bible.text(genesis)
+
+    hits, misses, maxsize, currsize = bible.cache_info()
+    assert (hits, misses, currsize) == (1, 4, 2)
+
+    # whole bible scan shouldn't touch the cache
+    for v in bible.iter_verses():
+        pass
+    assert bible.cache_info() == (hits, misses, maxsize, currsize)
+
+def test_verse_store():
+    from book_logic import load_bible, BOOK_INDEXES
+    from corpus import pack_id, unpack_id
+
+    corpus = load_bible().corpus
+    assert unpack_id(pack_id(18, 119, 176)) == (18, 119, 176)
+    assert list(corpus.ids) == sorted(corpus.ids)
+
+    psalms = BOOK_INDEXES['Psalms']
+    rows = corpus.chapter_rows(psalms, 23)
+    assert corpus.location(rows.start) == (psalms, 23, 1)
+    assert corpus.find_row(psalms, 23, 1) == rows.start
+    assert corpus.find_row(psalms, 23, 99) is None
+    assert rows.start in corpus.book_rows(psalms) and rows.stop-1 in corpus.book_rows(psalms)
+    assert corpus.chapter_rows(psalms, 151) == range(0)
+
+    # chapters and books tile the whole corpus without gaps
+    assert corpus.book_rows(0).start == 0
+    assert corpus.book_rows(len(BOOK_NAMES)-1).stop == corpus.num_verses
+
+def test_corpus_metadata():
+    from corpus import Corpus, write_corpus
+    from metadata import write_metadata, load_metadata
+    import tempfile
+
+    # second chapter skips verse 2, like Matthew 17:21
+    books = [{'1': {'1': 'a', '2': 'b'}, '2': {'1': 'c', '3': 'd'}}, {'1': 'e', '2': 'f', '3': 'g'}]
+    with tempfile.TemporaryDirectory() as folder:
+        corpus_fp, metadata_fp = Path(folder) / 'bible.bin', Path(folder) / 'metadata.json'
+        assert load_metadata(metadata_fp) is None
+        write_corpus(corpus_fp, books)
+        corpus = Corpus(corpus_fp)
+        write_metadata(metadata_fp, corpus, ['Genesis', 'Philemon'])
+        corpus.close()
+
+        metadata = load_metadata(metadata_fp)
+        assert metadata.chapter_counts == {'Genesis': 2, 'Philemon': 1}
+        assert metadata.verse_count(0, 2) == 2 and metadata.last_verse(0, 2) == 3
+        assert metadata.last_verse(1, 1) == 3 and metadata.last_verse(1, 2) == 0
+        assert metadata.has_verse(0, 2, 3) and not metadata.has_verse(0, 2, 4)
+
+        # its offsets stand in for the ones Corpus would compute
+        corpus = Corpus(corpus_fp, metadata)
+        assert corpus.chapter_starts is metadata.chapter_starts
+        assert corpus.chapter_rows(0, 2) == range(2, 4) and corpus.book_rows(1) == range(4, 7)
+        corpus.close()
+
+    # and the one setup wrote matches the real corpus
+    metadata = load_metadata(METADATA_FP)
+    corpus = Corpus(CORPUS_FP)
+    assert metadata.chapter_starts == corpus.chapter_starts
+    assert metadata.book_names == BOOK_NAMES
+    corpus.close()
+
+def test_compressed_corpus():
+    from corpus import Corpus, write_corpus, read_parsed_book
+    import tempfile
+
+    books = [{str(c): {str(v): 'And God said, Let there be light {}:{}.'.format(c, v) for v in range(1, 40)} for c in range(1, 30)},
+             {'1': 'Jude, a slave.', '2': 'May mercy ☧ increase.'}]
+    with tempfile.TemporaryDirectory() as folder:
+        fp = Path(folder) / 'bible.bin'
+        write_corpus(fp, books)
+        raw_size = sum(len(text.encode('utf-8')) for chapter in books[0].values() for text in chapter.values())
+        assert fp.stat().st_size < raw_size / 2
+
+        # a block per chapter, each readable alone
+        corpus = Corpus(fp)
+        assert len(corpus.block_rows) - 1 == 29 + 1
+        rows = corpus.chapter_rows(0, 7)
+        assert corpus.texts(rows) == [corpus.text(row) for row in rows] == list(books[0]['7'].values())
+        assert corpus.texts(range(rows.start - 3, rows.start + 3))[3] == 'And God said, Let there be light 7:1.'
+        assert read_parsed_book(corpus, 1) == {'1': books[1]}     # chapterless books come back as chapter 1
+        corpus.close()
+
+def test_fts_search():
+    from search import fts_query
+    import utils
+
+    assert fts_query('in the beg') == '"in the beg"*'
+    assert fts_query('in the ') == '"in the"'
+    assert fts_query('"in the beginning"') == '"in the beginning"'
+    assert fts_query('in.*beg') is None
+
+    init_data()
+    assert utils.data.search.db is not None
+    whole_bible = range(utils.data.bible.corpus.num_verses)
+
+    # indexed word search agrees with the equivalent regex scan
+    fts_rows = utils.data.search.search('love', whole_bible)
+    regex_rows = utils.data.search.search(r'(?i)\blove', whole_bible)
+    assert fts_rows == regex_rows
+
+    # scope by rowid range, same as scanning just those rows
+    from search import SearchEngine
+    scan = SearchEngine(utils.data.bible, None, utils.data.search.trigrams)
+    for scope in (utils.Scripture('Genesis', '3'), utils.Scripture('Psalms'), utils.Scripture('Revelation', '22')):
+        rows = utils.data.search.search('the', scripture_rows(scope))
+        assert rows and rows == scan.search('the', scripture_rows(scope)), scope
+
+    # the index narrows by rowid, rather than visiting every match in the bible
+    plan = utils.data.search.db.execute('EXPLAIN QUERY PLAN SELECT rowid FROM verses WHERE verses MATCH ? AND rowid >= ? AND rowid < ?',
+                                        ('the', 0, 10)).fetchall()
+    assert plan[0][-1].endswith('><'), plan     # fts5's index string: rowid lower and upper bound used
+
+def test_trigram_prefilter():
+    from trigrams import plan_regex, ANY
+    import utils
+
+    assert plan_regex('.*') is ANY
+    assert plan_regex('ab+') is ANY     # too short to narrow
+    op, args = plan_regex('Lord')     # lowercased like the index
+    assert op == 'and' and {t for _, t in args} == {'lor', 'ord'}
+    assert plan_regex('(king|lord)s')[0] == 'or'
+    assert plan_regex('(king)?|lord') is ANY
+
+    init_data()
+    search = utils.data.search
+    whole_bible = range(search.bible.corpus.num_verses)
+    index = search.trigrams
+
+    # narrowed results match a full scan
+    for pattern in (r'Jehovah.*said', r'(?i)BELOVED\b', r'(David|Lord) said', r'\bson of', r'[Ll]ord,'):
+        search.trigrams = None
+        full_scan = search.search(pattern, whole_bible)
+        search.trigrams = index
+        assert search.search(pattern, whole_bible) == full_scan, pattern
+
+def test_incremental_search():
+    from search import SearchEngine
+    from query import is_literal_extension
+    import utils
+
+    assert is_literal_extension('Jehovah,', 'Jehovah, said')
+    assert is_literal_extension('king.*Dav', 'king.*David')
+    assert not is_literal_extension('king', 'kings?')
+    assert not is_literal_extension(r'(a)\1', r'(a)\10')
+
+    init_data()
+    search = utils.data.search
+    whole_bible = range(search.bible.corpus.num_verses)
+
+    # typing then backspacing gives the same results as searching from scratch
+    typed = [r'king.*David,'[:i] for i in range(1, 13)]
+    for pattern in typed + typed[::-1]:
+        fresh = SearchEngine(search.bible, search.db, search.trigrams)
+        assert search.search(pattern, whole_bible) == fresh.search(pattern, whole_bible), pattern
+
+    # finishing an operator widens the query instead of narrowing it, with or without fts
+    for db in (search.db, None):
+        search = SearchEngine(search.bible, db, search.trigrams)
+        for text in ('Lord, AND x', 'Lord, OR x', 'Lord, NOT x', 'love NOT hat'):
+            for i in range(1, len(text) + 1):
+                fresh = SearchEngine(search.bible, db, search.trigrams)
+                assert search.search(text[:i], whole_bible) == fresh.search(text[:i], whole_bible), text[:i]
+
+def test_query_compiler():
+    from query import compile_query
+    from search import SearchEngine
+    import utils
+
+    assert compile_query('love').kind == 'words'
+    assert compile_query('Lord,').kind == 'literal'
+    assert compile_query('Lord.*said').kind == 'regex'
+    assert compile_query('love NOT hate').fts == '("love" NOT "hate"*)'
+    assert compile_query('love OR hope AND faith').fts == '("love" OR ("hope" AND "faith"*))'
+    assert compile_query('love AND').fts == '"love"'     # still typing
+    assert compile_query('love') is compile_query('love')     # cached
+
+    q = compile_query(r'\CLord NOT God')
+    assert q.matches('the Lord said') and not q.matches('the lord said') and not q.matches('Lord God')
+
+    init_data()
+    search = utils.data.search
+    whole_bible = range(search.bible.corpus.num_verses)
+    scan = SearchEngine(search.bible, None, search.trigrams)
+    full_scan = SearchEngine(search.bible, None, None)
+
+    # fts, trigram-narrowed scan, and full scan all agree
+    for text in ('love NOT God', 'love OR hope', '"son of" AND David', r'\CJehovah NOT jehovah', 'said, NOT Lord', 'the Lord,'):
+        results = full_scan.search(text, whole_bible)
+        assert scan.search(text, whole_bible) == results, text
+        assert search.search(text, whole_bible) == results, text
+
+def test_regex_time_limit():
+    from search import SearchEngine, RegexProcess, SearchTooExpensive
+    import utils
+    import time
+
+    init_data()
+    search = utils.data.search
+    whole_bible = range(search.bible.corpus.num_verses)
+    process = RegexProcess(CORPUS_FP, 1)
+    guarded = SearchEngine(search.bible, search.db, search.trigrams, process)
+    unguarded = SearchEngine(search.bible, search.db, search.trigrams)
+
+    # same results as running in this process
+    for pattern in (r'Jehovah.*said', r'\bson of', r'[0-9]'):
+        assert guarded.search(pattern, whole_bible) == unguarded.search(pattern, whole_bible), pattern
+
+    # catastrophic backtracking gets cut off
+    start = time.time()
+    try:
+        guarded.search(r'(\w+\s?)+$', whole_bible)
+        assert False, 'should have been stopped'
+    except SearchTooExpensive:
+        pass
+    assert time.time() - start < 5
+
+    # and searching carries on after
+    assert guarded.search(r'Jehovah.*said', whole_bible) == unguarded.search(r'Jehovah.*said', whole_bible)
+    process.close()
+
+    # a child that can't start is reported the same way
+    from unittest.mock import patch
+    with patch('multiprocessing.process.BaseProcess.start', side_effect=OSError('no more processes')):
+        try:
+            guarded.search(r'Jehovah.*sayeth', whole_bible)
+            assert False, 'should have failed'
+        except SearchTooExpensive:
+            pass
+    assert guarded.search(r'Jehovah.*sayeth', whole_bible) == unguarded.search(r'Jehovah.*sayeth', whole_bible)
+    process.close()
+
+def test_parallel_parsing():
+    import setup
+
+    zip = rtf_zip(SAMPLE_BOOKS)
+    fps = setup.book_filenames(zip)
+    assert fps == ['nwt_01_Ge_E.rtf', 'nwt_02_Ex_E.rtf']
+
+    # same books as parsing one at a time, whatever order they finish in
+    parsed = dict(setup.iter_parsed_books(zip, fps))
+    assert [parsed[i] for i in range(len(fps))] == [setup.parse_book_rtf(zip.read(fp))[0] for fp in fps]
+    assert parsed[0]['2'] == {'1': 'Thus were completed.'}
+
+def test_parse_book():
+    import setup
+
+    psalms = ('PSALMS\n1 Happy is the man\n2 Why are the nations restless?\n3 Psalm of David; see Psalm 3 also\n'
+              'Psalm 1\n1\xa0Happy is the man. 2\xa0But his delight.\n'
+              'Psalm 2\n1\xa0Why are the nations restless?\n'
+              'Psalm 3\nA melody of David when he ran away.\n1\xa0O Jehovah, why? 2\xa0Many, as in Psalm 3 they say.')
+    assert setup.parse_book(psalms) == {
+        '1': {'1': 'Happy is the man.', '2': 'But his delight.'},
+        '2': {'1': 'Why are the nations restless?'},
+        '3': {'1': 'O Jehovah, why?', '2': 'Many, as in Psalm 3 they say.'},  # superscription dropped, mention kept
+    }
+
+    jude = 'JUDE\nGreetings (1, 2)\n1\xa0Jude, a slave. 2\xa0May mercy\nand peace increase.'
+    assert setup.parse_book(jude) == {'1': 'Jude, a slave.', '2': 'May mercy\nand peace increase.'}
+
+    spans = list(setup.iter_verse_spans(jude))
+    assert [(chapter, verse) for chapter, verse, start, stop in spans] == [(None, '1'), (None, '2')]
+
+def test_incremental_setup():
+    import setup
+    import shared
+    import json
+    import tempfile
+    from corpus import Corpus, read_parsed_book
+    from trigrams import TrigramIndex
+    from unittest.mock import patch
+
+    folder = Path(tempfile.mkdtemp())
+    saved = (setup.fetch_content, shared.CORPUS_FP, shared.TRIGRAM_FP, shared.SEARCH_DB_FP, shared.MANIFEST_FP, shared.METADATA_FP)
+    shared.CORPUS_FP, shared.TRIGRAM_FP = folder / 'bible.bin', folder / 'trigrams.bin'
+    shared.SEARCH_DB_FP, shared.MANIFEST_FP = folder / 'search.db', folder / 'manifest.json'
+    shared.METADATA_FP = folder / 'metadata.json'
+    books = dict(SAMPLE_BOOKS)
+    setup.fetch_content = lambda *args: rtf_zip(books)
+    try:
+        report = setup.SetupReport()
+        assert list(setup.main_progress_iterator(report=report)) == ['Genesis', 'Exodus']
+        assert list(setup.main_progress_iterator()) == []     # nothing changed
+
+        # every stage timed, and each book parsed
+        assert [stage['stage'] for stage in report.stages] == [
+            'download', 'reuse unchanged books', 'unzip', 'parse', 'write corpus', 'write metadata', 'trigram index', 'search index']
+        assert sorted(book['book'] for book in report.books) == ['Exodus', 'Genesis']
+        assert report.stages[3]['bytes_in'] == sum(book['bytes_in'] for book in report.books) > 0
+        assert json.loads(json.dumps(report.to_json()))['total_seconds'] > 0
+        assert 'trigram index' in report.format_table()
+
+        # only the changed book is parsed again; it gains a verse, shifting rows after it
+        books['nwt_01_Ge_E.rtf'] = books['nwt_01_Ge_E.rtf'] + ' 3\xa0Added verse.'
+        assert list(setup.main_progress_iterator()) == ['Genesis']
+        corpus = Corpus(shared.CORPUS_FP)
+        assert read_parsed_book(corpus, 1) == {'1': {'1': 'Now these are the names.'}}
+        assert read_parsed_book(corpus, 0)['2']['3'] == 'Added verse.'
+        incremental = TrigramIndex(shared.TRIGRAM_FP)
+        corpus.close()
+
+        # a missing index is rebuilt even when no book changed
+        shared.SEARCH_DB_FP.unlink()
+        assert list(setup.main_progress_iterator()) == []
+        assert shared.SEARCH_DB_FP.exists()
+
+        # a setup that dies between writing the corpus and indexing it leaves nothing to patch from
+        books['nwt_02_Ex_E.rtf'] = books['nwt_02_Ex_E.rtf'] + ' 2\xa0Added verse.'
+        with patch('setup.update_trigram_index', side_effect=RuntimeError('killed')):
+            try:
+                list(setup.main_progress_iterator())
+                assert False, 'should have crashed'
+            except RuntimeError:
+                pass
+        assert setup.read_manifest() is None
+        assert list(setup.main_progress_iterator()) == ['Genesis', 'Exodus']
+        incremental = TrigramIndex(shared.TRIGRAM_FP)
+
+        # same index as building from scratch
+        assert list(setup.main_progress_iterator(force=True)) == ['Genesis', 'Exodus']
+        full = TrigramIndex(shared.TRIGRAM_FP)
+        assert (incremental.keys, incremental.starts, incremental.postings) == (full.keys, full.starts, full.postings)
+    finally:
+        setup.fetch_content, shared.CORPUS_FP, shared.TRIGRAM_FP, shared.SEARCH_DB_FP, shared.MANIFEST_FP, shared.METADATA_FP = saved
+        shutil.rmtree(str(folder))
+
+SAMPLE_BOOKS = {
+    'nwt_01_Ge_E.rtf': 'GENESIS\n1 Creation\n2 Eden\nChapter 1\n1\xa0In the beginning. 2\xa0Now the earth.\nChapter 2\n1\xa0Thus were completed.',
+    'nwt_02_Ex_E.rtf': 'EXODUS\n1 Slavery\nChapter 1\n1\xa0Now these are the names.',
+    'nwt_Foreword_E.rtf': 'Foreword',
+}
+
+def rtf_zip(books):
+    # in-memory zip shaped like the download, from {filename: plaintext}
+    buffer = BytesIO()
+    with ZipFile(buffer, 'w') as zip:
+        for name, text in books.items():
+            zip.writestr(name, '{\\rtf1\\ansi ' + text.replace('\n', '\\par\n').replace('\xa0', '\\u160?') + '}')
+    return ZipFile(buffer)
+
+def bible_zip():
+    # the real download, fetched once and kept
+    import setup
+    import shared
+    if not shared.BIBLE_ZIP_FP.exists():
+        setup.download(setup.BIBLE_URL, shared.BIBLE_ZIP_FP)
+    return ZipFile(str(shared.BIBLE_ZIP_FP))
+
+def test_fast_rtf_parity():
+    from rtf import rtf_to_text
+    from striprtf.striprtf import rtf_to_text as striprtf_to_text
+    import setup
+
+    tricky = [
+        r'{\rtf1{\fonttbl{\f0 Times;}}\f0 In the\~beginning\par}',
+        r'{\uc2 \u8212\'97\'97x \u-3913?y}',
+        r'{\*\generator ignored}a\{b\}c\\d \'e9\rquote s',
+        'line\r\nbreaks\n\\par kept}}unbalanced',
+        '\\',
+    ]
+    for text in tricky:
+        assert rtf_to_text(text) == striprtf_to_text(text), text
+
+    zip = bible_zip()
+    fps = setup.book_filenames(zip)
+    assert len(fps) == 66
+    for fp in fps:
+        book_rtf = zip.read(fp).decode('utf-8')
+        assert rtf_to_text(book_rtf) == striprtf_to_text(book_rtf), fp
+
+def test_fast_rtf_performance():
+    from rtf import rtf_to_text
+    from striprtf.striprtf import rtf_to_text as striprtf_to_text
+    import setup
+
+    zip = bible_zip()
+    books = [zip.read(fp).decode('utf-8') for fp in setup.book_filenames(zip)]
+    slow = timeit(lambda: [striprtf_to_text(book) for book in books], number=1)
+    fast = timeit(lambda: [rtf_to_text(book) for book in books], number=1)
+    print('striprtf {:.2f}s, rtf.py {:.2f}s, {:.1f}x faster'.format(slow, fast, slow / fast))
+    assert fast < slow
+
+def test_resumable_download():
+    import setup
+    import hashlib
+    import os
+    import tempfile
+
+    data = bytes(range(256)) * 4000     # ~1MB
+    server, url, requests_seen = serve_files({'/bible.zip': data}, drop_first_at=300000)
+    folder = tempfile.mkdtemp()
+    fp = os.path.join(folder, 'bible.zip')
+    progress = []
+    try:
+        # first response is cut off partway, and the retry picks up where it stopped
+        setup.download(url + '/bible.zip', fp, lambda done, total: progress.append((done, total)),
+                       sha256=hashlib.sha256(data).hexdigest())
+        with open(fp, 'rb') as file:
+            assert file.read() == data
+        assert not os.path.exists(fp + '.part')
+        assert requests_seen[1].get('Range', '').startswith('bytes=') and requests_seen[1]['Range'] != 'bytes=0-'
+        assert progress[-1] == (len(data), len(data))
+        assert all(a[0] <= b[0] for a, b in zip(progress, progress[1:]))
+
+        # a bad hash is refused and nothing is left behind
+        try:
+            setup.download(url + '/bible.zip', fp + '2', sha256='0'*64)
+            assert False, 'should have failed'
+        except setup.DownloadError:
+            assert not os.path.exists(fp + '2') and not os.path.exists(fp + '2.part')
+    finally:
+        server.shutdown()
+        shutil.rmtree(folder)
+
+def test_parallel_download():
+    import downloads
+    import hashlib
+    import os
+    import tempfile
+
+    data = os.urandom(downloads.PARALLEL_MIN_SIZE + 12345)
+    server, url, requests_seen = serve_files({'/update.zip': data})
+    folder = tempfile.mkdtemp()
+    fp = os.path.join(folder, 'update.zip')
+    progress = []
+    try:
+        downloads.download(url + '/update.zip', fp, lambda done, total: progress.append((done, total)),
+                           sha256=hashlib.sha256(data).hexdigest())
+        with open(fp, 'rb') as file:
+            assert file.read() == data
+
+        # split into ranges after the first response showed it was big enough
+        ranges = sorted(headers['Range'] for headers in requests_seen[1:])
+        assert len(ranges) == downloads.PARALLEL_RANGES
+        assert ranges[0].startswith('bytes=0-') and ranges[-1].endswith('-{}'.format(len(data)-1))
+        assert progress[-1] == (len(data), len(data))
+
+        # and small requests go through the same session
+        assert downloads.fetch_range(url + '/update.zip', 10, 20) == data[10:20]
+
+        # ranges that don't add up to the whole file are thrown out, even without a sha256
+        from unittest.mock import patch
+        os.remove(fp)
+        with patch('downloads._download_range', return_value=0):
+            try:
+                downloads.download(url + '/update.zip', fp)
+                assert False, 'should have failed'
+            except downloads.DownloadError:
+                pass
+        assert not os.path.exists(fp) and not os.path.exists(fp + '.part')
+    finally:
+        server.shutdown()
+        shutil.rmtree(folder)
+
+def test_conditional_download():
+    import setup
+    import shared
+    import os
+    import tempfile
+
+    folder = Path(tempfile.mkdtemp())
+    files = {'/bible.zip': b'version 1'}
+    server, url, requests_seen = serve_files(files)
+    fp = folder / 'bible.zip'
+    try:
+        assert setup.download(url + '/bible.zip', fp, conditional=True)
+        # unchanged: server answers 304, file is left alone
+        assert not setup.download(url + '/bible.zip', fp, conditional=True)
+        assert requests_seen[-1]['If-None-Match']
+        # changed upstream
+        files['/bible.zip'] = b'version 2'
+        assert setup.download(url + '/bible.zip', fp, conditional=True)
+        assert fp.read_bytes() == b'version 2'
+
+        # setup stops before parsing anything when the source is unchanged, unless forced
+        saved = (setup.BIBLE_URL, shared.BIBLE_ZIP_FP, shared.CORPUS_FP, shared.METADATA_FP,
+                 shared.TRIGRAM_FP, shared.SEARCH_DB_FP, shared.MANIFEST_FP)
+        setup.BIBLE_URL = url + '/bible.zip'
+        shared.BIBLE_ZIP_FP = fp
+        shared.CORPUS_FP, shared.METADATA_FP = folder / 'bible.bin', folder / 'metadata.json'
+        shared.TRIGRAM_FP, shared.SEARCH_DB_FP = folder / 'trigrams.bin', folder / 'search.db'
+        shared.MANIFEST_FP = folder / 'manifest.json'
+        setup.write_manifest({}, setup.write_outputs([{'1': 'Jude, a slave.'}]))
+        try:
+            assert list(setup.main_progress_iterator()) == []
+            try:
+                list(setup.main_progress_iterator(force=True))
+                assert False, 'should have downloaded and tried to unzip'
+            except setup.DownloadError:
+                pass
+            # or when the corpus is in a format from an older version
+            shared.CORPUS_FP.write_bytes(b'FBIB')
+            try:
+                list(setup.main_progress_iterator())
+                assert False, 'should have downloaded and tried to unzip'
+            except setup.DownloadError:
+                pass
+        finally:
+            (setup.BIBLE_URL, shared.BIBLE_ZIP_FP, shared.CORPUS_FP, shared.METADATA_FP,
+             shared.TRIGRAM_FP, shared.SEARCH_DB_FP, shared.MANIFEST_FP) = saved
+    finally:
+        server.shutdown()
+        shutil.rmtree(str(folder))
+
+def test_delta_update():
+    import updating
+    import json
+    import os
+    import tempfile
+    from zipfile import ZIP_DEFLATED, ZIP_STORED
+
+    folder = Path(tempfile.mkdtemp())
+    release = {
+        'Fast Bible.exe': os.urandom(50000),
+        'data/chapter_counts.csv': b'Genesis,50\n' * 100,
+        'settings/base.json': b'{"version": "0.2.0"}',
+        'new.dll': b'added this release',
+    }
+    zip_fp = folder / 'updated_files.zip'
+    with ZipFile(str(zip_fp), 'w') as _zip:
+        for path, content in release.items():
+            # every member under one folder, as zipped for a release
+            compression = ZIP_STORED if path.endswith('.exe') else ZIP_DEFLATED
+            _zip.writestr('target/' + path, content, compress_type=compression)
+    updating.write_release_manifest(zip_fp, folder / 'manifest.json')
+    manifest = json.loads((folder / 'manifest.json').read_text())
+    assert sorted(manifest['files']) == sorted(release)
+
+    # install has the old exe and settings, and the same data
+    install = folder / 'install'
+    for path, content in release.items():
+        if path != 'new.dll':
+            (install / path).parent.mkdir(parents=True, exist_ok=True)
+            (install / path).write_bytes(content)
+    (install / 'Fast Bible.exe').write_bytes(os.urandom(50000))
+    (install / 'settings/base.json').write_bytes(b'{"version": "0.1.0"}')
+    assert sorted(updating.changed_files(manifest, install)) == ['Fast Bible.exe', 'new.dll', 'settings/base.json']
+
+    server, url, requests_seen = serve_files({'/updated_files.zip': zip_fp.read_bytes()})
+    try:
+        updates = folder / 'updates'
+        fetched = updating.download_changed_files(url + '/updated_files.zip', manifest, install, updates)
+        assert sorted(fetched) == ['Fast Bible.exe', 'new.dll', 'settings/base.json']
+        for path in fetched:
+            assert (updates / path).read_bytes() == release[path]
+        assert not (updates / 'data').exists()
+        # one small range request per file, never the whole zip
+        assert len(requests_seen) == 3 and all('Range' in headers for headers in requests_seen)
+
+        # a member that doesn't match its manifest is refused
+        entry = dict(manifest['files']['new.dll'], sha256='0' * 64)
+        try:
+            updating.fetch_zip_member(url + '/updated_files.zip', entry, BytesIO())
+            assert False, 'should have failed the checksum'
+        except ValueError:
+            pass
+    finally:
+        server.shutdown()
+        shutil.rmtree(str(folder))
+
+def test_streaming_update_download():
+    import updating
+    import json
+    import os
+    import tempfile
+    import tracemalloc
+    from zipfile import ZIP_DEFLATED, ZIP_STORED
+
+    folder = Path(tempfile.mkdtemp())
+    big = os.urandom(8 << 20)
+    compressible = b'In the beginning God created the heavens and the earth. ' * (150 << 10)
+    zip_fp = folder / 'updated_files.zip'
+    with ZipFile(str(zip_fp), 'w') as _zip:
+        _zip.writestr('target/Fast Bible.exe', big, compress_type=ZIP_STORED)
+        _zip.writestr('target/Qt5Core.dll', compressible, compress_type=ZIP_DEFLATED)
+        _zip.writestr('target/data/chapter_counts.csv', b'Genesis,50\n')
+    updating.write_release_manifest(zip_fp, folder / 'manifest.json')
+    manifest = json.loads((folder / 'manifest.json').read_text())
+    server, url, requests_seen = serve_files({'/updated_files.zip': zip_fp.read_bytes()})
+    try:
+        # whole zip, and just the changed members, each a few chunks at most in memory
+        for method in ('zip', 'manifest'):
+            updates = folder / method
+            tracemalloc.start()
+            if method == 'zip':
+                with updating.download_zip(url + '/updated_files.zip') as _zip:
+                    updating.unzip(_zip, updates)
+            else:
+                updating.download_changed_files(url + '/updated_files.zip', manifest, folder / 'install', updates)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            assert (updates / 'Fast Bible.exe').read_bytes() == big
+            assert (updates / 'Qt5Core.dll').read_bytes() == compressible
+            assert (updates / 'data/chapter_counts.csv').read_bytes() == b'Genesis,50\n'
+            assert peak < 1 << 20, (method, peak)
+    finally:
+        server.shutdown()
+        shutil.rmtree(str(folder))
+
+def test_update_checks():
+    import updating
+    import json
+    import tempfile
+
+    folder = Path(tempfile.mkdtemp())
+    zip_buffer = BytesIO()
+    with ZipFile(zip_buffer, 'w') as _zip:
+        _zip.writestr('target/new.dll', b'added this release')
+    files = {'/updated_files.zip': zip_buffer.getvalue()}
+    server, url, requests_seen = serve_files(files)
+    files['/latest'] = json.dumps({'tag_name': 'v99.0', 'assets': [
+        {'name': 'updated_files.zip', 'browser_download_url': url + '/updated_files.zip'}]}).encode()
+
+    settings_fp = folder / 'settings.ini'
+    settings = QSettings(str(settings_fp), QSettings.IniFormat)
+    checker = updating.UpdateChecker(settings_fp, '0.1', url + '/latest', folder / 'install', folder / 'updates')
+    try:
+        # downloads a newer release on a daemon thread
+        assert checker.start() and checker.thread.daemon
+        checker.thread.join(10)
+        settings.sync()
+        assert settings.value('updated', type=bool)
+        assert (folder / 'updates/new.dll').read_bytes() == b'added this release'
+
+        # not again until the interval has passed
+        seen = len(requests_seen)
+        assert not checker.start()
+        assert len(requests_seen) == seen
+
+        # then the same release is only a 304
+        settings.setValue('update_check_interval', 0)
+        settings.setValue('updated', False)
+        settings.sync()
+        assert checker.start()
+        checker.thread.join(10)
+        settings.sync()
+        assert requests_seen[-1]['If-None-Match'] and not settings.value('updated', type=bool)
+
+        # once cancelled, a download stops at its first chunk
+        shutil.rmtree(str(folder / 'updates'))
+        checker.cancel()
+        try:
+            checker.download_update(url + '/updated_files.zip')
+            assert False, 'should have been cancelled'
+        except updating.UpdateCancelled:
+            pass
+        assert not (folder / 'updates/new.dll').exists()
+
+        # a broken download, or one taking too long, ends the check quietly and leaves it for next time
+        from unittest.mock import patch
+        files['/broken.zip'] = b'<html>not found</html>'
+        files['/latest'] = json.dumps({'tag_name': 'v99.1', 'assets': [
+            {'name': 'updated_files.zip', 'browser_download_url': url + '/broken.zip'}]}).encode()
+        assert checker.start()
+        checker.thread.join(10)
+        with patch('updating.UPDATE_TIME_LIMIT', 0):
+            files['/latest'] = files['/latest'].replace(b'/broken.zip', b'/updated_files.zip')
+            assert checker.start()
+            checker.thread.join(10)
+        settings.sync()
+        assert not settings.value('updated', type=bool)
+        assert not (folder / 'updates/new.dll').exists()
+    finally:
+        checker.cancel()
+        server.shutdown()
+        shutil.rmtree(str(folder))
+
+def test_apply_update():
+    import updating
+    import os
+    import subprocess
+    import tempfile
+    import time
+    from threading import Thread
+    from unittest.mock import patch
+
+    def make_install(folder):
+        install = folder / 'install'
+        for path, content in {'Fast Bible.exe': b'old exe', 'data/chapter_counts.csv': b'old csv', 'keep.txt': b'kept'}.items():
+            (install / path).parent.mkdir(parents=True, exist_ok=True)
+            (install / path).write_bytes(content)
+        updates = install / 'updates'
+        for path, content in {'Fast Bible.exe': b'new exe', 'data/chapter_counts.csv': b'new csv', 'lib/new.dll': b'new dll'}.items():
+            (updates / path).parent.mkdir(parents=True, exist_ok=True)
+            (updates / path).write_bytes(content)
+        return install, updates
+
+    def tree(install):
+        return {fp.relative_to(install).as_posix(): fp.read_bytes() for fp in install.rglob('*') if fp.is_file()}
+
+    folder = Path(tempfile.mkdtemp())
+    try:
+        # waits for the app to close before touching anything
+        install, updates = make_install(folder)
+        app = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(0.5)'])
+        Thread(target=app.wait, daemon=True).start()    # reaped, like an app that's fully gone
+        start = time.time()
+        applied = updating.apply_staged_update(install, updates, app.pid)
+        assert time.time() - start >= 0.4
+        assert applied == ['Fast Bible.exe', 'data/chapter_counts.csv', 'lib/new.dll']
+        assert tree(install) == {'Fast Bible.exe': b'new exe', 'data/chapter_counts.csv': b'new csv',
+                                 'lib/new.dll': b'new dll', 'keep.txt': b'kept'}
+        assert not updates.exists()
+        shutil.rmtree(str(install))
+
+        # a failed swap puts every file back, and keeps the update for next time
+        install, updates = make_install(folder)
+        before = tree(install)
+        real_replace = os.replace
+        def failing_replace(src, dst):
+            if src.endswith('new.dll' + updating._STAGED_SUFFIX):
+                raise PermissionError('file in use')
+            real_replace(src, dst)
+        with patch('updating.os.replace', side_effect=failing_replace):
+            try:
+                updating.apply_staged_update(install, updates)
+                assert False, 'should have failed'
+            except PermissionError:
+                pass
+        assert tree(install) == before
+
+        # gives up on an app that never closes
+        app = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+        try:
+            updating.apply_staged_update(install, updates, app.pid, timeout=0.2)
+            assert False, 'should have timed out'
+        except TimeoutError:
+            pass
+        finally:
+            app.kill()
+        assert tree(install) == before
+
+        # the next session's quit starts the applier again, even with nothing newly downloaded
+        cwd = os.getcwd()
+        os.chdir(str(install))
+        try:
+            qt_app = updating.AutoUpdatingApp([])
+            with patch('updating.subprocess.Popen') as popen:
+                qt_app.quit()
+        finally:
+            os.chdir(cwd)
+        command = popen.call_args[0][0]
+
+        # a relaunch that fails doesn't stop the app quitting
+        with patch('updating.subprocess.Popen', side_effect=OSError('no such file')):
+            qt_app.apply_update()
+        assert command[-4:] == [updating.APPLY_UPDATE_ARG, str(os.getpid()), str(install), str(updates)]
+        closed = subprocess.Popen([sys.executable, '-c', 'pass'])
+        closed.wait()
+        assert updating.apply_update_main([str(closed.pid)] + command[-2:]) == 0
+        assert tree(install) == {'Fast Bible.exe': b'new exe', 'data/chapter_counts.csv': b'new csv',
+                                 'lib/new.dll': b'new dll', 'keep.txt': b'kept'}
+        assert not updating.has_staged_update(updates)
+    finally:
+        shutil.rmtree(str(folder))
+
+def serve_files(files, drop_first_at=None):
+    '''Stand-in download server on localhost, running on a background thread.
+    Honors Range and If-None-Match requests. drop_first_at: cut off the first response after that many bytes.
+    Returns (server, base url, headers of each request, in order).'''
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from threading import Thread
+    import hashlib
+    import re
+
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(dict(self.headers))
+            if self.path not in files:
+                self.send_error(404)
+                return
+            data = files[self.path]
+            etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+
+            start, stop = 0, len(data)
+            match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+            if match:
+                start = int(match.group(1))
+                if match.group(2):
+                    stop = min(stop, int(match.group(2)) + 1)
+                if start >= len(data):
+                    self.send_error(416)
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, stop-1, len(data)))
+            else:
+                self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(stop - start))
+            self.end_headers()
+
+            body = memoryview(data)[start:stop]     # no copy, for tests measuring memory
+            if drop_first_at is not None and len(requests_seen) == 1:
+                body = body[:drop_first_at]
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass    # client stopped reading, like a download switching to ranges
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_port), requests_seen
+
 def test_search_performance():
     # try a caching decorator! no need to store list maybe or copy iterator
     pass